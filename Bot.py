@@ -1,3 +1,6 @@
+import time
+_PROCESS_START = time.perf_counter()
+
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
@@ -7,16 +10,364 @@ import os
 import sys
 import re
 import asyncio
-import difflib
 import io
-from PIL import Image
+import argparse
+import contextlib
+import importlib
+import math
+import bisect
+import functools
+import threading
+import queue
+import logging
+import logging.handlers
+import traceback
+import hashlib
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta, timezone
-import dateparser
-import pytz
+
+# --- STARTUP PROFILING ---
+PROFILE_STARTUP = False
+startup_phases = [] # (phase name, seconds)
+
+@contextlib.contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases.append((name, time.perf_counter() - start))
+
+startup_phases.append(("import discord + stdlib", time.perf_counter() - _PROCESS_START))
+
+def report_startup_profile():
+    total = time.perf_counter() - _PROCESS_START
+    lines = [f"⏱️ Startup profile ({total * 1000:.0f} ms since process start):"]
+    for name, seconds in startup_phases:
+        lines.append(f"   {name:<32} {seconds * 1000:>9.1f} ms")
+    log_event("startup_profile", "\n".join(lines), total_ms=round(total * 1000, 1))
+
+# --- LAZY HEAVY IMPORTS ---
+# dateparser (locale data), Pillow and pytz are only needed once messages arrive,
+# so they are imported on first use instead of delaying the gateway connection.
+HEAVY_MODULES = ('pytz', 'difflib', 'PIL.Image', 'dateparser')
+_lazy_modules = {}
+
+def lazy_import(module_name):
+    module = _lazy_modules.get(module_name)
+    if module is None:
+        with startup_phase(f"import {module_name}"):
+            module = importlib.import_module(module_name)
+        _lazy_modules[module_name] = module
+    return module
+
+def warm_heavy_imports():
+    for module_name in HEAVY_MODULES:
+        lazy_import(module_name)
+    # The first parse loads dateparser's language data; do it here instead of in a handler.
+    with startup_phase("dateparser first parse"):
+        lazy_import('dateparser').parse("tomorrow at 5pm")
 
 # --- FILE PATHS ---
 CONFIG_FILE = 'server_config.json'
 USER_DATA_FILE = 'user_data.json'
+BACKFILL_STATE_FILE = 'backfill_state.json'
+AUDIT_FILE = 'moderation_audit.jsonl'
+COMMAND_SYNC_STATE_FILE = 'command_sync_state.json'
+PID_FILE = 'bot.pid'
+AUDIT_INDEX_FILE = 'moderation_audit.idx'
+
+# --- EVENT LOG ---
+# Handlers only put a record on a queue; a listener thread does the console output and writes
+# JSON lines to a size-rotated file, so a slow disk or terminal never stalls the event loop.
+# Moderation actions also go through here, into the append-only audit trail below.
+LOG_DEFAULTS = {
+    "event_log_file": "bot_events.jsonl",
+    "max_bytes": 5 * 1024 * 1024,
+    "backup_count": 3
+}
+
+event_logger = logging.getLogger("verifybot")
+event_logger.setLevel(logging.INFO)
+event_logger.propagate = False
+event_log_queue = queue.SimpleQueue()
+event_log_listener = None
+event_file_handler = None
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if getattr(record, "audit", None):
+            entry["audit"] = record.audit
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class AuditTrailHandler(logging.Handler):
+    def emit(self, record):
+        entry = getattr(record, "audit", None)
+        if entry is None: return
+        try:
+            append_audit_entry(entry)
+        except Exception:
+            self.handleError(record)
+
+def get_log_setting(key):
+    return config_data.get("logging", {}).get(key, LOG_DEFAULTS[key])
+
+def start_event_log():
+    global event_log_listener, event_file_handler
+    if event_log_listener: return
+    event_file_handler = logging.handlers.RotatingFileHandler(
+        get_log_setting("event_log_file"), maxBytes=get_log_setting("max_bytes"),
+        backupCount=get_log_setting("backup_count"), encoding='utf-8', delay=True)
+    event_file_handler.setFormatter(JsonLineFormatter())
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+    event_log_listener = logging.handlers.QueueListener(
+        event_log_queue, console_handler, event_file_handler, AuditTrailHandler())
+    event_log_listener.start()
+    event_logger.addHandler(logging.handlers.QueueHandler(event_log_queue))
+
+def apply_log_settings():
+    # Rotation limits can change on /reload; the file name is fixed for the life of the process.
+    if event_file_handler:
+        event_file_handler.maxBytes = get_log_setting("max_bytes")
+        event_file_handler.backupCount = get_log_setting("backup_count")
+
+def stop_event_log():
+    global event_log_listener
+    if event_log_listener:
+        event_log_listener.stop() # drains whatever is still queued
+        event_log_listener = None
+        event_logger.handlers.clear()
+
+def log_event(event, message, level=logging.INFO, **fields):
+    if not event_log_listener:
+        # Offline CLI modes and imports without main(): plain output, nothing to rotate.
+        print(message)
+        return
+    event_logger.log(level, message, extra={"event": event, "fields": fields})
+
+# --- MODERATION AUDIT TRAIL ---
+# moderation_audit.jsonl is only ever appended to. The sidecar index holds one
+# "<offset>\t<guild>\t<user>\t<action>" line per record, so /audit_query looks up byte offsets
+# and seeks straight to the matching records instead of reading the whole trail.
+
+audit_index = {} # ("guild", gid) / ("user", gid, uid) / ("action", gid, action) -> [offsets]
+audit_lock = threading.Lock()
+
+def index_audit_entry(offset, guild_id, user_id, action):
+    for key in (("guild", guild_id), ("user", guild_id, user_id), ("action", guild_id, action)):
+        audit_index.setdefault(key, []).append(offset)
+
+def append_audit_entry(entry):
+    line = (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+    guild_id, user_id, action = str(entry["guild_id"]), str(entry["user_id"]), entry["action"]
+    with audit_lock:
+        with open(AUDIT_FILE, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+        with open(AUDIT_INDEX_FILE, 'a', encoding='utf-8') as f:
+            f.write(f"{offset}\t{guild_id}\t{user_id}\t{action}\n")
+        index_audit_entry(offset, guild_id, user_id, action)
+
+def load_audit_index():
+    audit_index.clear()
+    last_offset = None
+    if os.path.exists(AUDIT_INDEX_FILE):
+        with open(AUDIT_INDEX_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 4: continue
+                offset = int(parts[0])
+                index_audit_entry(offset, parts[1], parts[2], parts[3])
+                last_offset = offset
+    if not os.path.exists(AUDIT_FILE): return
+
+    # Records written after the last indexed one (e.g. a crash between the two appends) get indexed now.
+    recovered = 0
+    with open(AUDIT_FILE, 'rb') as f, open(AUDIT_INDEX_FILE, 'a', encoding='utf-8') as idx:
+        if last_offset is not None:
+            f.seek(last_offset)
+            f.readline()
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line: break
+            try:
+                entry = json.loads(line)
+                guild_id, user_id, action = str(entry["guild_id"]), str(entry["user_id"]), entry["action"]
+            except (ValueError, KeyError):
+                continue
+            idx.write(f"{offset}\t{guild_id}\t{user_id}\t{action}\n")
+            index_audit_entry(offset, guild_id, user_id, action)
+            recovered += 1
+    if recovered:
+        log_event("audit_reindexed", f"🗃️ Indexed {recovered} audit records missing from '{AUDIT_INDEX_FILE}'.")
+
+def query_audit(guild_id, user_id=None, action=None, limit=10):
+    """Newest-first audit records for a guild, optionally narrowed to a user and/or action."""
+    guild_id = str(guild_id)
+    with audit_lock:
+        candidates = [audit_index.get(("guild", guild_id), [])]
+        if user_id is not None:
+            candidates.append(audit_index.get(("user", guild_id, str(user_id)), []))
+        if action is not None:
+            candidates.append(audit_index.get(("action", guild_id, action), []))
+        candidates = [list(offsets) for offsets in candidates]
+
+    offsets = min(candidates, key=len)
+    if len(candidates) > 1:
+        others = [set(c) for c in candidates if c is not offsets]
+        offsets = [o for o in offsets if all(o in other for other in others)]
+
+    entries = []
+    if not offsets: return entries
+    with open(AUDIT_FILE, 'rb') as f:
+        for offset in reversed(offsets[-limit:]):
+            f.seek(offset)
+            try:
+                entries.append(json.loads(f.readline()))
+            except ValueError:
+                pass
+    return entries
+
+def audit_action(action, guild, user, message, **inputs):
+    """Records a moderation action (and its inputs) in the audit trail and the event log."""
+    entry = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "action": action,
+        "guild_id": str(guild.id),
+        "user_id": str(user.id),
+        "user": str(user),
+        "account_age_days": (datetime.now(timezone.utc) - user.created_at).days
+    }
+    entry.update(inputs)
+    if not event_log_listener:
+        append_audit_entry(entry)
+        print(message)
+        return
+    event_logger.info(message, extra={"event": "moderation_action", "fields": {}, "audit": entry})
+
+# --- EVENT LOOP LAG WATCHDOG ---
+# Opt-in ("lag_watchdog": {"enabled": true}). A daemon thread schedules a no-op callback on the
+# loop every interval_ms and waits for it to run. While it is overdue by more than threshold_ms,
+# the loop thread's stack is sampled with sys._current_frames(), and the stall is charged to the
+# call site seen most often. One threadsafe callback per interval keeps the cost negligible.
+LAG_WATCHDOG_DEFAULTS = {
+    "enabled": False,
+    "interval_ms": 100,
+    "threshold_ms": 250,
+    "top_n": 10,
+    "report_minutes": 60
+}
+
+lag_stats = {"probes": 0, "stalls": 0, "max_lag_ms": 0.0, "since": None}
+lag_sites = {} # call site -> {"stalls", "total_ms", "worst_ms", "stack"}
+lag_lock = threading.Lock()
+lag_watchdog_stop = None # threading.Event of the running watchdog
+lag_watchdog_thread = None
+
+def get_lag_setting(key):
+    return config_data.get("lag_watchdog", {}).get(key, LAG_WATCHDOG_DEFAULTS[key])
+
+def describe_blocking_site(frame):
+    """'<our frame> → <innermost frame>': the line in this file to fix, and what it was stuck in."""
+    innermost = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+    own = frame
+    while own is not None and own.f_code.co_filename != __file__:
+        own = own.f_back
+    if own is None or own is frame:
+        return innermost
+    return f"{os.path.basename(__file__)}:{own.f_lineno} {own.f_code.co_name} → {innermost}"
+
+def record_loop_stall(lag_ms, samples, stacks):
+    site, _ = samples.most_common(1)[0]
+    with lag_lock:
+        lag_stats["stalls"] += 1
+        stats = lag_sites.setdefault(site, {"stalls": 0, "total_ms": 0.0, "worst_ms": 0.0, "stack": None})
+        stats["stalls"] += 1
+        stats["total_ms"] += lag_ms
+        if lag_ms >= stats["worst_ms"]:
+            stats["worst_ms"] = lag_ms
+            stats["stack"] = stacks[site]
+    log_event("loop_stall", f"🐢 Event loop blocked for {lag_ms:.0f} ms in {site}", logging.WARNING,
+              lag_ms=round(lag_ms, 1), site=site, stack=stacks[site])
+
+def top_lag_sites(n):
+    with lag_lock:
+        ranked = sorted(lag_sites.items(), key=lambda item: item[1]["total_ms"], reverse=True)
+        return [(site, dict(stats)) for site, stats in ranked[:n]]
+
+def format_lag_report(n):
+    lines = [f"{stats['total_ms']:>8.0f} ms total, {stats['stalls']:>4} stalls, worst {stats['worst_ms']:.0f} ms: {site}"
+             for site, stats in top_lag_sites(n)]
+    return "\n".join(lines)
+
+def lag_watchdog(loop, loop_thread_id, stop):
+    lag_stats["since"] = datetime.now(timezone.utc)
+    last_report = time.monotonic()
+    reported_stalls = 0
+    while not stop.is_set():
+        threshold = get_lag_setting("threshold_ms") / 1000
+        acked = threading.Event()
+        sent = time.perf_counter()
+        try:
+            loop.call_soon_threadsafe(acked.set)
+        except RuntimeError:
+            return # loop closed
+        samples = Counter()
+        stacks = {}
+        while not acked.wait(threshold):
+            if stop.is_set(): return
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None: continue
+            site = describe_blocking_site(frame)
+            samples[site] += 1
+            if site not in stacks:
+                stacks[site] = "".join(traceback.format_list(traceback.extract_stack(frame, limit=8)))
+            del frame
+        lag_ms = (time.perf_counter() - sent) * 1000
+        with lag_lock:
+            if stop.is_set(): return # stopped while waiting; the stats were already cleared
+            lag_stats["probes"] += 1
+            lag_stats["max_lag_ms"] = max(lag_stats["max_lag_ms"], lag_ms)
+        if samples:
+            record_loop_stall(lag_ms, samples, stacks)
+
+        if time.monotonic() - last_report >= get_lag_setting("report_minutes") * 60:
+            last_report = time.monotonic()
+            if lag_stats["stalls"] > reported_stalls:
+                reported_stalls = lag_stats["stalls"]
+                top_n = get_lag_setting("top_n")
+                log_event("lag_report", f"🐢 Top {top_n} blocking call sites:\n{format_lag_report(top_n)}",
+                          sites=top_lag_sites(top_n))
+        stop.wait(get_lag_setting("interval_ms") / 1000)
+
+def apply_lag_watchdog():
+    """Starts or stops the watchdog to match the config; call from the event loop thread."""
+    global lag_watchdog_thread, lag_watchdog_stop
+    running = lag_watchdog_thread is not None and lag_watchdog_thread.is_alive()
+    if get_lag_setting("enabled") and not running:
+        lag_watchdog_stop = threading.Event()
+        lag_watchdog_thread = threading.Thread(
+            target=lag_watchdog, args=(asyncio.get_running_loop(), threading.get_ident(), lag_watchdog_stop),
+            name="lag-watchdog", daemon=True)
+        lag_watchdog_thread.start()
+        log_event("lag_watchdog", f"🐢 Event loop lag watchdog on (threshold {get_lag_setting('threshold_ms')} ms).")
+    elif not get_lag_setting("enabled") and running:
+        lag_watchdog_stop.set()
+        lag_watchdog_thread = None
+        # Clear the stats so /lag_report says the watchdog is off instead of showing a frozen report.
+        with lag_lock:
+            lag_sites.clear()
+            lag_stats.update(probes=0, stalls=0, max_lag_ms=0.0, since=None)
+        log_event("lag_watchdog", "🐢 Event loop lag watchdog off.")
 
 # --- CONFIG LOADER ---
 config_data = {}
@@ -26,34 +377,35 @@ RULES = {}
 LANGUAGES_CONFIG = {}
 user_profiles = {}
 msg_translation_map = {} # Maps user_message_id -> bot_reply_message_id
+msg_reply_text = {} # Maps user_message_id -> text of the bot reply last sent for it
 
 def save_config():
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config_data, f, indent=4, ensure_ascii=False)
 
-def load_config():
+def load_config(require_token=True):
     global config_data, TOKEN, MIN_AGE, RULES, LANGUAGES_CONFIG
     
     if not os.path.exists(CONFIG_FILE):
-        print(f"❌ CRITICAL ERROR: '{CONFIG_FILE}' not found.")
+        log_event("config_error", f"❌ CRITICAL ERROR: '{CONFIG_FILE}' not found.", logging.ERROR)
         return False
     
     try:
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             config_data = json.load(f)
     except json.JSONDecodeError as e:
-        print(f"❌ JSON ERROR: {e}")
+        log_event("config_error", f"❌ JSON ERROR: {e}", logging.ERROR)
         return False
 
-    if not config_data.get("bot_token") or config_data["bot_token"] == "PASTE_YOUR_BOT_TOKEN_HERE":
-        print("❌ Invalid Token.")
+    if require_token and (not config_data.get("bot_token") or config_data["bot_token"] == "PASTE_YOUR_BOT_TOKEN_HERE"):
+        log_event("config_error", "❌ Invalid Token.", logging.ERROR)
         return False
         
     if "languages" not in config_data:
-        print("❌ Missing 'languages' section.")
+        log_event("config_error", "❌ Missing 'languages' section.", logging.ERROR)
         return False
 
-    TOKEN = config_data['bot_token']
+    TOKEN = config_data.get('bot_token', "")
     MIN_AGE = config_data.get('min_account_age_days', 7)
     RULES = config_data.get('rules', {})
     LANGUAGES_CONFIG = config_data.get('languages', {})
@@ -66,22 +418,91 @@ def load_config():
         "cacac75c785ccd98": "Smartphone transaction success"
     }
 
+    # Defaults live in memory only; they are written out with the next save_config().
     if "scam_hashes" not in config_data:
         config_data["scam_hashes"] = default_signatures
-        save_config()
+    rebuild_scam_index()
+    guild_config_cache.clear()
+    apply_log_settings()
     
-    print(f"✅ Configuration loaded: {len(RULES)} rules, {len(LANGUAGES_CONFIG)} languages.")
+    log_event("config_loaded", f"✅ Configuration loaded: {len(RULES)} rules, {len(LANGUAGES_CONFIG)} languages.",
+              rules=len(RULES), languages=len(LANGUAGES_CONFIG))
+    if config_data.get("guild_config_dir"):
+        log_event("config_loaded", f"🗂️ Per-guild config shards in '{config_data['guild_config_dir']}/', loaded on first use.")
     return True
 
+# --- GUILD CONFIG SHARDS ---
+# With "guild_config_dir" set, each guild's settings live in their own <dir>/<guild_id>.json, which
+# may also override "rules" and "languages". Shards load on first use into a bounded LRU cache and
+# a settings change rewrites only that guild's file. Without it, everything stays in
+# server_config.json under "guild_settings" as before.
+
+guild_config_cache = OrderedDict() # guild_id (str) -> shard dict
+
+def guild_shard_path(gid):
+    return os.path.join(config_data["guild_config_dir"], f"{gid}.json")
+
+def load_guild_shard(gid):
+    path = guild_shard_path(gid)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            log_event("config_error", f"❌ Error loading guild config '{path}': {e}", logging.ERROR, path=path)
+            return {}
+    # Not migrated yet: start from the guild's entry in the single-file layout.
+    return dict(config_data.get('guild_settings', {}).get(gid, {}))
+
+def get_guild_config(guild_id):
+    gid = str(guild_id)
+    if not config_data.get("guild_config_dir"):
+        return config_data.get('guild_settings', {}).get(gid, {})
+
+    shard = guild_config_cache.get(gid)
+    if shard is not None:
+        guild_config_cache.move_to_end(gid)
+        return shard
+    shard = guild_config_cache[gid] = load_guild_shard(gid)
+    while len(guild_config_cache) > config_data.get("guild_cache_size", 256):
+        guild_config_cache.popitem(last=False)
+    return shard
+
+def edit_guild_config(guild_id):
+    """Returns the guild's settings dict for modification; persist with save_guild_config()."""
+    gid = str(guild_id)
+    if not config_data.get("guild_config_dir"):
+        return config_data.setdefault("guild_settings", {}).setdefault(gid, {})
+    return get_guild_config(gid)
+
+def save_guild_config(guild_id):
+    gid = str(guild_id)
+    if not config_data.get("guild_config_dir"):
+        save_config()
+        return
+    shard = get_guild_config(gid)
+    path = guild_shard_path(gid)
+    os.makedirs(config_data["guild_config_dir"], exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(shard, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def get_rules(guild_id):
+    return get_guild_config(guild_id).get("rules") or RULES
+
+def get_languages(guild_id):
+    return get_guild_config(guild_id).get("languages") or LANGUAGES_CONFIG
+
 def load_user_data():
     global user_profiles
     if os.path.exists(USER_DATA_FILE):
         try:
             with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
                 user_profiles = json.load(f)
-            print(f"✅ Loaded {len(user_profiles)} user profiles from '{USER_DATA_FILE}'.")
+            log_event("user_data_loaded", f"✅ Loaded {len(user_profiles)} user profiles from '{USER_DATA_FILE}'.", profiles=len(user_profiles))
         except Exception as e:
-            print(f"❌ Error loading '{USER_DATA_FILE}': {e}")
+            log_event("user_data_error", f"❌ Error loading '{USER_DATA_FILE}': {e}", logging.ERROR)
             user_profiles = {}
     else:
         user_profiles = {}
@@ -91,12 +512,7 @@ def save_user_data():
         with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
             json.dump(user_profiles, f, indent=4, ensure_ascii=False)
     except Exception as e:
-        print(f"❌ Error saving '{USER_DATA_FILE}': {e}")
-
-# Load configurations
-if not load_config():
-    sys.exit(1)
-load_user_data()
+        log_event("user_data_error", f"❌ Error saving '{USER_DATA_FILE}': {e}", logging.ERROR)
 
 # Data Storage
 pending_verifications = {}
@@ -136,15 +552,17 @@ def normalize_text(text):
 def is_close_match(user_input, expected, threshold=0.85):
     norm_user = normalize_text(user_input)
     norm_expected = normalize_text(expected)
-    matcher = difflib.SequenceMatcher(None, norm_user, norm_expected)
+    matcher = lazy_import('difflib').SequenceMatcher(None, norm_user, norm_expected)
     return matcher.ratio() >= threshold
 
-def get_lang_label(code):
-    return LANGUAGES_CONFIG.get(code, {}).get("label", code)
+def get_lang_label(code, guild_id=None):
+    languages = get_languages(guild_id) if guild_id else LANGUAGES_CONFIG
+    return languages.get(code, {}).get("label", code)
 
-def generate_complicated_math():
-    if not RULES: return "1 + 0", 1 
-    rule_keys = [int(k) for k in RULES.keys() if k.isdigit()]
+def generate_complicated_math(rules=None):
+    rules = RULES if rules is None else rules
+    if not rules: return "1 + 0", 1 
+    rule_keys = [int(k) for k in rules.keys() if k.isdigit()]
     max_rule = max(rule_keys) if rule_keys else 12
     target = random.randint(1, max_rule)
     
@@ -278,117 +696,1452 @@ def extract_and_parse_all(text):
         
     return results
 
-def add_to_translation_map(user_msg_id, bot_reply_id):
+def add_to_translation_map(user_msg_id, bot_reply_id, reply_text=None):
     if len(msg_translation_map) >= 1000:
         oldest_key = next(iter(msg_translation_map))
         msg_translation_map.pop(oldest_key, None)
+        msg_reply_text.pop(oldest_key, None)
     msg_translation_map[user_msg_id] = bot_reply_id
+    if reply_text is not None:
+        msg_reply_text[user_msg_id] = reply_text
+
+def build_time_reply(content, user_tz_name):
+    """Parses every time/date in the message and returns the bot's reply text, or None."""
+    parsed_segments = extract_and_parse_all(content)
+    epochs = []
+    
+    if parsed_segments:
+        try:
+            pytz = lazy_import('pytz')
+            dateparser = lazy_import('dateparser')
+            user_tz = pytz.timezone(user_tz_name)
+            now_user_time = datetime.now(user_tz)
+            
+            for segment_text, format_type in parsed_segments:
+                preprocessed_text = preprocess_natural_time(segment_text)
+                settings = {
+                    'PREFER_DATES_FROM': 'future',
+                    'RELATIVE_BASE': now_user_time.replace(tzinfo=None),
+                    'TIMEZONE': user_tz_name,
+                    'RETURN_AS_TIMEZONE_AWARE': True
+                }
+                
+                parsed_dt = dateparser.parse(preprocessed_text, settings=settings)
+                if parsed_dt:
+                    epoch = int(parsed_dt.timestamp())
+                    epochs.append((epoch, format_type))
+        except Exception:
+            pass
+    
+    if not epochs:
+        return None
+    formatted_times = [f"<t:{epoch}:{fmt}>" for epoch, fmt in epochs]
+    if len(formatted_times) == 1:
+        return f"The user means {formatted_times[0]}"
+    elif len(formatted_times) == 2:
+        return f"The user means {formatted_times[0]} or {formatted_times[1]}"
+    return f"The user means {', '.join(formatted_times[:-1])}, or {formatted_times[-1]}"
+
+# --- TIMEZONE SEARCH INDEX ---
+# Built once off the event loop (and refreshed so current offsets follow DST). Autocomplete then
+# only does dict/bisect lookups, ranked exact > prefix > substring > fuzzy, then by how many of
+# our users picked the zone.
+
+FALLBACK_TIMEZONES = [
+    "UTC", "US/Eastern", "US/Central", "US/Mountain", "US/Pacific",
+    "Europe/London", "Europe/Paris", "Europe/Berlin", "Asia/Tokyo",
+    "Asia/Kolkata", "Asia/Singapore", "Australia/Sydney", "America/Sao_Paulo"
+]
+
+# Common abbreviations and city names that don't appear in any zone name, mapped to their usual zone.
+TIMEZONE_ALIASES = {
+    "ist": "Asia/Kolkata", "india": "Asia/Kolkata", "mumbai": "Asia/Kolkata", "bombay": "Asia/Kolkata",
+    "delhi": "Asia/Kolkata", "new delhi": "Asia/Kolkata", "bangalore": "Asia/Kolkata", "calcutta": "Asia/Kolkata",
+    "pst": "America/Los_Angeles", "pdt": "America/Los_Angeles", "pacific": "America/Los_Angeles",
+    "san francisco": "America/Los_Angeles", "seattle": "America/Los_Angeles",
+    "est": "America/New_York", "edt": "America/New_York", "eastern": "America/New_York",
+    "nyc": "America/New_York", "boston": "America/New_York", "washington": "America/New_York",
+    "cst": "America/Chicago", "cdt": "America/Chicago", "central": "America/Chicago",
+    "dallas": "America/Chicago", "houston": "America/Chicago",
+    "mst": "America/Denver", "mdt": "America/Denver", "mountain": "America/Denver",
+    "akst": "America/Anchorage", "hst": "Pacific/Honolulu", "hawaii": "Pacific/Honolulu",
+    "gmt": "Europe/London", "bst": "Europe/London", "uk": "Europe/London",
+    "cet": "Europe/Berlin", "cest": "Europe/Berlin", "eet": "Europe/Athens", "eest": "Europe/Athens",
+    "wet": "Europe/Lisbon", "msk": "Europe/Moscow", "kiev": "Europe/Kyiv",
+    "jst": "Asia/Tokyo", "japan": "Asia/Tokyo", "kst": "Asia/Seoul", "korea": "Asia/Seoul",
+    "hkt": "Asia/Hong_Kong", "beijing": "Asia/Shanghai", "china": "Asia/Shanghai",
+    "sgt": "Asia/Singapore", "pht": "Asia/Manila", "wib": "Asia/Jakarta", "ict": "Asia/Bangkok",
+    "saigon": "Asia/Ho_Chi_Minh", "pkt": "Asia/Karachi",
+    "aest": "Australia/Sydney", "aedt": "Australia/Sydney", "acst": "Australia/Adelaide",
+    "awst": "Australia/Perth", "nzst": "Pacific/Auckland", "nzdt": "Pacific/Auckland",
+    "brt": "America/Sao_Paulo", "brazil": "America/Sao_Paulo", "sast": "Africa/Johannesburg"
+}
+
+TZ_OFFSET_RE = re.compile(r'(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?')
+TZ_TIER_EXACT, TZ_TIER_PREFIX, TZ_TIER_SUBSTRING, TZ_TIER_FUZZY = 4, 3, 2, 1
+
+timezone_index = None
+timezone_popularity = Counter() # zone -> number of users who saved it
+
+def format_utc_offset(delta):
+    minutes = int(delta.total_seconds() // 60)
+    sign = '+' if minutes >= 0 else '-'
+    hours, minutes = divmod(abs(minutes), 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
+
+def normalize_tz_query(text):
+    text = re.sub(r'\s+', ' ', text.strip().lower().replace('_', ' '))
+    match = TZ_OFFSET_RE.fullmatch(text)
+    if match:
+        sign, hours, minutes = match.groups()
+        return f"{sign}{int(hours):02d}:{minutes or '00'}"
+    return text
+
+def _tz_trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_timezone_index():
+    pytz = lazy_import('pytz')
+    zones = list(pytz.common_timezones)
+    now = datetime.now(timezone.utc)
+    keys = {} # search key -> set of zones
+    offsets = {}
+
+    def add(key, zone):
+        keys.setdefault(key, set()).add(zone)
+
+    for zone in zones:
+        tz = pytz.timezone(zone)
+        name = zone.lower().replace('_', ' ')
+        add(name, zone)
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            add('/'.join(parts[i:]), zone) # "new york", "indiana/indianapolis"
+
+        offsets[zone] = format_utc_offset(now.astimezone(tz).utcoffset())
+        add(offsets[zone], zone)
+        for month in (1, 7):
+            abbreviation = tz.localize(datetime(now.year, month, 15)).tzname()
+            if abbreviation and abbreviation[0] not in '+-':
+                add(abbreviation.lower(), zone)
+
+    preferred = set()
+    for alias, zone in TIMEZONE_ALIASES.items():
+        if zone in offsets:
+            add(alias, zone)
+            preferred.add((alias, zone))
+
+    trigrams = {}
+    for key in keys:
+        for trigram in _tz_trigrams(key):
+            trigrams.setdefault(trigram, []).append(key)
+
+    return {
+        "zones": zones,
+        "order": {zone: i for i, zone in enumerate(zones)},
+        "offsets": offsets,
+        "keys": keys,
+        "sorted_keys": sorted(keys),
+        "trigrams": trigrams,
+        "preferred": preferred
+    }
+
+def refresh_timezone_popularity():
+    timezone_popularity.clear()
+    timezone_popularity.update(p["timezone"] for p in user_profiles.values() if p.get("timezone"))
+    search_timezones.cache_clear()
+
+@functools.lru_cache(maxsize=2048)
+def search_timezones(query, limit=25):
+    index = timezone_index
+    q = normalize_tz_query(query)
+    if not q:
+        ranked = sorted(index["zones"], key=lambda z: (-timezone_popularity[z], index["order"][z]))
+        return tuple(ranked[:limit])
+
+    best = {} # zone -> (tier, via preferred alias, similarity)
+    def offer(key, tier, similarity=1.0):
+        for zone in index["keys"][key]:
+            score = (tier, tier == TZ_TIER_EXACT and (key, zone) in index["preferred"], similarity)
+            if score > best.get(zone, (0, False, 0.0)):
+                best[zone] = score
+
+    if q in index["keys"]:
+        offer(q, TZ_TIER_EXACT)
+
+    sorted_keys = index["sorted_keys"]
+    i = bisect.bisect_left(sorted_keys, q)
+    while i < len(sorted_keys) and sorted_keys[i].startswith(q):
+        offer(sorted_keys[i], TZ_TIER_PREFIX)
+        i += 1
+
+    if len(q) < 3:
+        # Too short for trigrams; a plain scan over a few thousand keys is still well under a millisecond.
+        for key in sorted_keys:
+            if q in key:
+                offer(key, TZ_TIER_SUBSTRING)
+    else:
+        q_trigrams = _tz_trigrams(q)
+        shared = Counter()
+        for trigram in q_trigrams:
+            for key in index["trigrams"].get(trigram, ()):
+                shared[key] += 1
+        for key, count in shared.items():
+            if q in key:
+                offer(key, TZ_TIER_SUBSTRING)
+            elif q[0] not in '+-': # "+05:30" must not fuzzy-match "+05:00"
+                similarity = count / (len(q_trigrams) + len(_tz_trigrams(key)) - count)
+                if similarity >= 0.2:
+                    offer(key, TZ_TIER_FUZZY, similarity)
+
+    ranked = sorted(best, key=lambda z: (
+        -best[z][0], -best[z][1], -timezone_popularity[z], -best[z][2], index["order"][z]
+    ))
+    return tuple(ranked[:limit])
 
 # --- DYNAMIC IMAGE DHASH MODERATION ---
 
+def bits_to_hex(bits):
+    decimal_value = 0
+    hex_string = []
+    for index, value in enumerate(bits):
+        if value:
+            decimal_value += 2 ** (index % 8)
+        if (index % 8) == 7:
+            hex_string.append(hex(decimal_value)[2:].rjust(2, '0'))
+            decimal_value = 0
+    return ''.join(hex_string)
+
+def image_dhash(gray_img, hash_size=8):
+    Image = lazy_import('PIL.Image')
+    img = gray_img.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(img.getdata())
+    
+    difference = []
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            difference.append(left > right)
+    return bits_to_hex(difference)
+
+_DCT_SIZE = 32
+_DCT_COS = [[math.cos(math.pi * (2 * x + 1) * u / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)] for u in range(8)]
+
+def image_phash(gray_img):
+    # DCT perceptual hash: 32x32 greyscale, keep the 8x8 lowest frequencies, threshold on their median.
+    Image = lazy_import('PIL.Image')
+    img = gray_img.resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.LANCZOS)
+    pixels = list(img.getdata())
+    rows = [pixels[y * _DCT_SIZE:(y + 1) * _DCT_SIZE] for y in range(_DCT_SIZE)]
+
+    # Separable DCT-II, computing only the coefficients that end up in the hash.
+    row_coeffs = [[sum(p * c for p, c in zip(row, _DCT_COS[u])) for u in range(8)] for row in rows]
+    coeffs = []
+    for v in range(8):
+        cos_v = _DCT_COS[v]
+        for u in range(8):
+            coeffs.append(sum(row_coeffs[y][u] * cos_v[y] for y in range(_DCT_SIZE)))
+
+    median = sorted(coeffs[1:])[31] # DC term excluded, it only encodes overall brightness
+    return bits_to_hex([c > median for c in coeffs])
+
 def bytes_dhash(img_bytes, hash_size=8):
+    Image = lazy_import('PIL.Image')
     try:
         with Image.open(io.BytesIO(img_bytes)) as img:
-            img = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
-            pixels = list(img.getdata())
-            
-            difference = []
-            for row in range(hash_size):
-                for col in range(hash_size):
-                    left = pixels[row * (hash_size + 1) + col]
-                    right = pixels[row * (hash_size + 1) + col + 1]
-                    difference.append(left > right)
-            
-            decimal_value = 0
-            hex_string = []
-            for index, value in enumerate(difference):
-                if value:
-                    decimal_value += 2 ** (index % 8)
-                if (index % 8) == 7:
-                    hex_string.append(hex(decimal_value)[2:].rjust(2, '0'))
-                    decimal_value = 0
-            return ''.join(hex_string)
+            return image_dhash(img.convert('L'), hash_size)
     except Exception:
         return None
 
+def bytes_template_hashes(img_bytes):
+    """Returns (dhash, phash) for a template image, or (None, None) if it can't be decoded."""
+    Image = lazy_import('PIL.Image')
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            gray = img.convert('L')
+            return image_dhash(gray), image_phash(gray)
+    except Exception:
+        return None, None
+
 def hamming_distance(hash1, hash2):
     if len(hash1) != len(hash2):
         return 999
     return bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
 
-async def handle_scam_match(message, attachment, matched_hash, distance, label):
+# --- SCAM HASH CASCADE ---
+# Stage 1 is a permissive dHash lookup; only its candidates pay for the DCT pHash confirmation.
+# Templates registered before pHashes were stored have nothing to confirm against and keep the
+# old single-stage rule (dHash distance <= legacy threshold).
+
+CASCADE_DEFAULTS = {
+    "dhash_threshold": 18,
+    "phash_threshold": 10,
+    "legacy_dhash_threshold": 12,
+    "ingest_dedupe_distance": 6
+}
+
+scam_index = [] # Precomputed template entries, rebuilt whenever templates change
+cascade_stats = {
+    "images_hashed": 0,
+    "stage1_candidates": 0,
+    "stage2_checked": 0,
+    "stage2_confirmed": 0,
+    "legacy_matches": 0,
+    "animated_images": 0,
+    "frames_hashed": 0,
+    "frame_cache_hits": 0
+}
+cascade_stats_lock = threading.Lock() # hashing runs on pool threads
+
+def new_cascade_stats():
+    return dict.fromkeys(cascade_stats, 0)
+
+def count_stat(stats, key, amount=1):
+    with cascade_stats_lock:
+        stats[key] += amount
+
+def get_cascade_setting(key):
+    return config_data.get("scam_cascade", {}).get(key, CASCADE_DEFAULTS[key])
+
+def rebuild_scam_index():
+    global scam_index
+    meta_table = config_data.get("scam_template_meta", {})
+    index = []
+    for template_hash, label in config_data.get("scam_hashes", {}).items():
+        try:
+            value = int(template_hash, 16)
+        except ValueError:
+            continue
+        meta = meta_table.get(template_hash, {})
+        phash = meta.get("phash")
+        if phash:
+            dhash_threshold = meta.get("dhash_threshold", get_cascade_setting("dhash_threshold"))
+        else:
+            dhash_threshold = meta.get("dhash_threshold", get_cascade_setting("legacy_dhash_threshold"))
+        index.append({
+            "hash": template_hash,
+            "value": value,
+            "label": label,
+            "phash": int(phash, 16) if phash else None,
+            "dhash_threshold": dhash_threshold,
+            "phash_threshold": meta.get("phash_threshold", get_cascade_setting("phash_threshold"))
+        })
+    scam_index = index
+
+def cascade_match(h, get_phash, stats):
+    """Runs both stages for one image's dHash; get_phash() is only called if stage 1 finds candidates."""
+    value = int(h, 16)
+    candidates = []
+    for entry in scam_index:
+        dist = bin(value ^ entry["value"]).count('1')
+        if dist <= entry["dhash_threshold"]:
+            candidates.append((dist, entry))
+    if not candidates:
+        return None
+    count_stat(stats, "stage1_candidates", 1)
+    candidates.sort(key=lambda c: c[0])
+
+    phash_value = None
+    for dist, entry in candidates:
+        if entry["phash"] is None:
+            count_stat(stats, "legacy_matches", 1)
+            return h, dist, entry["label"], None
+        if phash_value is None:
+            phash_value = int(get_phash(), 16)
+            count_stat(stats, "stage2_checked", 1)
+        phash_dist = bin(phash_value ^ entry["phash"]).count('1')
+        if phash_dist <= entry["phash_threshold"]:
+            count_stat(stats, "stage2_confirmed", 1)
+            return h, dist, entry["label"], phash_dist
+    return None
+
+def match_scam_cascade(img_bytes, stats=None):
+    """Returns (image_dhash, dhash_distance, label, phash_distance) for the best confirmed template, or None."""
+    # History scans pass their own stats so they don't skew the live numbers in /scam_scan_stats.
+    stats = cascade_stats if stats is None else stats
+    Image = lazy_import('PIL.Image')
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if getattr(img, "n_frames", 1) > 1:
+                return match_animated_frames(img, img_bytes, stats)
+            gray = img.convert('L')
+            h = image_dhash(gray)
+            count_stat(stats, "images_hashed", 1)
+            return cascade_match(h, lambda: image_phash(gray), stats)
+    except Exception:
+        return None
+
+# --- ANIMATED IMAGES ---
+# GIF/WebP frames can only be decoded in order, so the decode budget (frames x pixels) caps how
+# far into the animation we read, and up to max_animation_frames evenly spaced frames within
+# that prefix are hashed together. Frame hashes are cached by a digest of the file, so a GIF
+# reposted across channels is decoded once; matching the cached hashes is just XORs.
+
+frame_hash_cache = OrderedDict() # blake2b digest of the file -> [(dhash, phash)] of the sampled frames
+frame_hash_cache_lock = threading.Lock()
+
+def sample_frame_indices(frame_count, width, height):
+    budget_frames = max(1, get_scan_setting("animation_pixel_budget") // max(1, width * height))
+    decodable = min(frame_count, budget_frames)
+    count = min(get_scan_setting("max_animation_frames"), decodable)
+    if count <= 1:
+        return [0]
+    return sorted({round(i * (decodable - 1) / (count - 1)) for i in range(count)})
+
+def hash_sampled_frames(img, stats):
+    grays = []
+    for index in sample_frame_indices(img.n_frames, *img.size):
+        img.seek(index)
+        grays.append(img.convert('L'))
+    count_stat(stats, "frames_hashed", len(grays))
+    return [(image_dhash(gray), image_phash(gray)) for gray in grays]
+
+def match_animated_frames(img, img_bytes, stats):
+    digest = hashlib.blake2b(img_bytes, digest_size=16).digest()
+    with frame_hash_cache_lock:
+        frames = frame_hash_cache.get(digest)
+        if frames is not None:
+            frame_hash_cache.move_to_end(digest)
+    if frames is None:
+        frames = hash_sampled_frames(img, stats)
+        with frame_hash_cache_lock:
+            frame_hash_cache[digest] = frames
+            while len(frame_hash_cache) > get_scan_setting("frame_cache_size"):
+                frame_hash_cache.popitem(last=False)
+    else:
+        count_stat(stats, "frame_cache_hits", 1)
+    count_stat(stats, "animated_images", 1)
+    count_stat(stats, "images_hashed", 1)
+    return match_hash_pairs(frames, stats)
+
+def match_hash_pairs(pairs, stats):
+    """Best cascade match over precomputed (dhash, phash) pairs; only XORs, so cheap to repeat."""
+    best = None
+    for h, phash in pairs:
+        result = cascade_match(h, lambda phash=phash: phash, stats)
+        if result and (best is None or result[1] < best[1]):
+            best = result
+    return best
+
+def image_hash_pairs(img_bytes, stats):
+    """(dhash, phash) of a still image, or of the sampled frames of an animated one; [] if undecodable."""
+    Image = lazy_import('PIL.Image')
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            count_stat(stats, "images_hashed", 1)
+            if getattr(img, "n_frames", 1) > 1:
+                count_stat(stats, "animated_images", 1)
+                return hash_sampled_frames(img, stats)
+            gray = img.convert('L')
+            return [(image_dhash(gray), image_phash(gray))]
+    except Exception:
+        return []
+
+# --- BULK TEMPLATE INGESTION ---
+
+MAX_INGEST_FILES = 500
+MAX_INGEST_FILE_BYTES = 16 * 1024 * 1024
+MAX_INGEST_TOTAL_BYTES = 128 * 1024 * 1024 # uncompressed, across one archive
+HASH_FEED_RE = re.compile(r'^([0-9a-fA-F]{16})[\s,;]+(.+)$')
+_hash_pool = None
+
+def get_hash_pool():
+    # Pillow releases the GIL while decoding and resizing, so threads hash in parallel
+    # without blocking the event loop.
+    global _hash_pool
+    if _hash_pool is None:
+        import concurrent.futures
+        _hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2), thread_name_prefix="hash")
+    return _hash_pool
+
+def template_record_from_bytes(label, img_bytes):
+    Image = lazy_import('PIL.Image')
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            width, height = img.size
+            gray = img.convert('L')
+            return {
+                "label": label,
+                "hash": image_dhash(gray),
+                "meta": {"width": width, "height": height, "size": len(img_bytes), "phash": image_phash(gray)}
+            }
+    except Exception:
+        return {"label": label, "hash": None, "meta": {}}
+
+def parse_hash_feed(text):
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = HASH_FEED_RE.match(line)
+        if match:
+            records.append({"label": match.group(2).strip(), "hash": match.group(1).lower(), "meta": {}})
+        else:
+            records.append({"label": line[:60], "hash": None, "meta": {}})
+    return records
+
+def plan_template_ingest(records, dedupe_distance):
+    """Splits hashed records into (added, duplicates, failed), deduping against existing templates and each other."""
+    existing = dict(config_data.get("scam_hashes", {}))
+    added, duplicates, failed = [], [], []
+    for record in records:
+        h = record["hash"]
+        if not h:
+            failed.append(record)
+            continue
+        nearest = None
+        for known_hash, known_label in existing.items():
+            dist = hamming_distance(h, known_hash)
+            if dist <= dedupe_distance and (nearest is None or dist < nearest[1]):
+                nearest = (known_label, dist)
+        if nearest:
+            duplicates.append((record, nearest[0], nearest[1]))
+            continue
+        existing[h] = record["label"]
+        added.append(record)
+    return added, duplicates, failed
+
+def commit_template_ingest(added):
+    if not added:
+        return
+    if "scam_hashes" not in config_data or isinstance(config_data["scam_hashes"], list):
+        config_data["scam_hashes"] = {}
+    meta_table = config_data.setdefault("scam_template_meta", {})
+    for record in added:
+        config_data["scam_hashes"][record["hash"]] = record["label"]
+        if record["meta"]:
+            meta_table[record["hash"]] = record["meta"]
+    save_config()
+    rebuild_scam_index()
+
+def format_ingest_summary(added, duplicates, failed):
+    lines = [f"+ {r['hash']}  {r['label']}" for r in added]
+    lines += [f"= {r['hash']}  {r['label']}  (dup of '{known}', dist {dist})" for r, known, dist in duplicates]
+    lines += [f"! {r['label']}  (unreadable)" for r in failed]
+    header = f"{len(added)} added, {len(duplicates)} duplicates skipped, {len(failed)} failed"
+    return header, "\n".join(lines)
+
+def extract_zip_templates(data, label_prefix):
+    """Reads template images out of a zip within the per-file and total uncompressed size caps."""
+    import zipfile
+    items = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(SCANNED_IMAGE_EXTENSIONS):
+                continue
+            if info.file_size > MAX_INGEST_FILE_BYTES:
+                continue
+            if len(items) >= MAX_INGEST_FILES:
+                break
+            total += info.file_size
+            if total > MAX_INGEST_TOTAL_BYTES:
+                raise ValueError(f"archive expands to more than {MAX_INGEST_TOTAL_BYTES // (1024 * 1024)} MB of images")
+            stem = os.path.splitext(os.path.basename(info.filename))[0]
+            label = f"{label_prefix} {stem}" if label_prefix else stem
+            items.append((label, zf.read(info)))
+    return items
+
+def bot_is_running():
+    """True if another process started the bot from this directory and is still alive."""
+    try:
+        with open(PID_FILE, 'r') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # exists but owned by someone else
+    return True
+
+def run_template_ingest_cli(path, dedupe_distance, dry_run):
+    import concurrent.futures
+
+    if not dry_run and bot_is_running():
+        # The running bot holds the config in memory and its next save_config() would drop our additions.
+        print(f"❌ The bot is running (see '{PID_FILE}'). Stop it first, use --dry-run, or import with /import_scam_templates.")
+        sys.exit(1)
+
+    if os.path.isdir(path):
+        items = []
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(SCANNED_IMAGE_EXTENSIONS):
+                with open(os.path.join(path, name), 'rb') as f:
+                    items.append((os.path.splitext(name)[0], f.read()))
+        # Offline there's no event loop to protect, so use processes for full CPU parallelism.
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            records = list(pool.map(template_record_from_bytes, [i[0] for i in items], [i[1] for i in items], chunksize=8))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            records = parse_hash_feed(f.read())
+
+    if dedupe_distance is None:
+        dedupe_distance = get_cascade_setting("ingest_dedupe_distance")
+    added, duplicates, failed = plan_template_ingest(records, dedupe_distance)
+    header, diff = format_ingest_summary(added, duplicates, failed)
+    print(diff)
+    print(f"📥 {header}.")
+    if dry_run:
+        print("ℹ️ Dry run, nothing written.")
+    else:
+        commit_template_ingest(added)
+
+# --- ATTACHMENT SCAN PIPELINE ---
+
+SCANNED_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+
+SCAN_DEFAULTS = {
+    "max_bytes": 25 * 1024 * 1024, # larger files are scanned from the deferred queue, one at a time
+    "max_bytes_in_flight": 64 * 1024 * 1024,
+    "min_dimension": 64,
+    "aspect_tolerance": 0.35,
+    "max_concurrent_downloads": 8,
+    "per_guild_concurrent_downloads": 4,
+    "per_user_concurrent_downloads": 2,
+    "per_user_bytes_per_minute": 32 * 1024 * 1024,
+    "flagged_account_ttl_seconds": 600,
+    "max_animation_frames": 8,
+    "animation_pixel_budget": 16 * 1024 * 1024,
+    "frame_cache_size": 2048
+}
+
+def get_scan_setting(key):
+    return config_data.get("attachment_scan", {}).get(key, SCAN_DEFAULTS[key])
+
+DISCORD_UPLOAD_LIMIT = 500 * 1024 * 1024 # largest attachment Discord accepts (Nitro)
+
+def get_template_aspects():
+    """Aspect ratios of all templates, or None if any template's shape is unknown (then any shape may match)."""
+    meta_table = config_data.get("scam_template_meta", {})
+    aspects = []
+    for template_hash in config_data.get("scam_hashes", {}):
+        meta = meta_table.get(template_hash, {})
+        if not (meta.get("width") and meta.get("height")):
+            return None
+        aspects.append(meta["width"] / meta["height"])
+    return aspects
+
+def learn_template_shape(matched_hash, distance, label, width, height):
+    """Stores the shape of a confirmed match for the template it hit, if that template had none.
+
+    The built-in templates and hash-feed imports come without dimensions, which keeps the aspect
+    check off; each one gets its shape from its first real match, so the check turns on over time.
+    """
+    if not (width and height):
+        return
+    value = int(matched_hash, 16)
+    for entry in scam_index:
+        if entry["label"] != label or bin(value ^ entry["value"]).count('1') != distance:
+            continue
+        meta = config_data.setdefault("scam_template_meta", {}).setdefault(entry["hash"], {})
+        if not (meta.get("width") and meta.get("height")):
+            meta.update(width=width, height=height)
+            save_config()
+            log_event("template_shape_learned", f"📐 Template '{label}' is {width}x{height}; aspect screening now uses it.",
+                      template=entry["hash"], width=width, height=height)
+        return
+
+def prescreen_attachment(attachment):
+    """Returns None when the attachment is worth downloading, otherwise the reason it was skipped."""
+    if not attachment.filename.lower().endswith(SCANNED_IMAGE_EXTENSIONS):
+        return "extension"
+    if attachment.content_type and not attachment.content_type.startswith("image/"):
+        return "content type"
+    if attachment.size > DISCORD_UPLOAD_LIMIT:
+        return "too large"
+
+    width, height = attachment.width, attachment.height
+    if width and height:
+        if min(width, height) < get_scan_setting("min_dimension"):
+            return "too small"
+        # Templates are screenshots with a known shape; a banner or a tall strip can't be a near-duplicate.
+        aspects = get_template_aspects()
+        if aspects:
+            ratio = width / height
+            tolerance = 1 + get_scan_setting("aspect_tolerance")
+            if not any(1 / tolerance <= ratio / aspect <= tolerance for aspect in aspects):
+                return "aspect ratio"
+    return None
+
+_download_semaphore = None
+download_bytes_in_flight = 0
+download_bytes_freed = asyncio.Event()
+guild_download_slots = {} # guild_id -> [Semaphore, holders]
+user_download_slots = {} # user_id -> [Semaphore, holders]
+user_download_bytes = {} # user_id -> [window_start, bytes]
+
+def _acquire_keyed_slot(table, key, limit):
+    entry = table.get(key)
+    if entry is None:
+        entry = table[key] = [asyncio.Semaphore(limit), 0]
+    entry[1] += 1
+    return entry
+
+def _release_keyed_slot(table, key, entry):
+    entry[1] -= 1
+    if entry[1] <= 0:
+        table.pop(key, None)
+
+@contextlib.asynccontextmanager
+async def download_bytes(size):
+    """Holds size bytes of the global in-flight budget; a file bigger than the budget waits to run alone."""
+    global download_bytes_in_flight
+    size = min(size, get_scan_setting("max_bytes_in_flight"))
+    while download_bytes_in_flight and download_bytes_in_flight + size > get_scan_setting("max_bytes_in_flight"):
+        await download_bytes_freed.wait()
+    download_bytes_in_flight += size
+    try:
+        yield
+    finally:
+        download_bytes_in_flight -= size
+        # set() wakes every current waiter; clear() only rearms the event for the next round.
+        download_bytes_freed.set()
+        download_bytes_freed.clear()
+
+@contextlib.asynccontextmanager
+async def download_slot(guild_id, user_id, size):
+    global _download_semaphore
+    if _download_semaphore is None:
+        _download_semaphore = asyncio.Semaphore(get_scan_setting("max_concurrent_downloads"))
+
+    guild_entry = _acquire_keyed_slot(guild_download_slots, guild_id, get_scan_setting("per_guild_concurrent_downloads"))
+    user_entry = _acquire_keyed_slot(user_download_slots, user_id, get_scan_setting("per_user_concurrent_downloads"))
+    try:
+        # Always acquired in the same order (user -> guild -> global -> bytes), so waiters can't deadlock.
+        async with user_entry[0], guild_entry[0], _download_semaphore, download_bytes(size):
+            yield
+    finally:
+        _release_keyed_slot(user_download_slots, user_id, user_entry)
+        _release_keyed_slot(guild_download_slots, guild_id, guild_entry)
+
+def reserve_user_download_bytes(user_id, size):
+    now = time.monotonic()
+    if len(user_download_bytes) > 5000:
+        for key in [k for k, (start, _) in user_download_bytes.items() if now - start >= 60]:
+            del user_download_bytes[key]
+
+    window = user_download_bytes.get(user_id)
+    if window is None or now - window[0] >= 60:
+        window = user_download_bytes[user_id] = [now, 0]
+    # A file bigger than the whole budget still goes through on its own in a fresh window.
+    if window[1] and window[1] + size > get_scan_setting("per_user_bytes_per_minute"):
+        return False
+    window[1] += size
+    return True
+
+def seconds_until_budget_resets(user_id):
+    window = user_download_bytes.get(user_id)
+    return max(0.0, window[0] + 60 - time.monotonic()) if window else 0.0
+
+# Attachments over a user's byte budget are scanned later instead of being skipped; otherwise
+# posting several large files at once would be a way around the scan.
+deferred_scans = {} # user_id -> deque of (message, attachment) waiting for budget
+deferred_scan_tasks = {} # user_id -> task draining that deque
+
+def defer_attachment_scan(message, attachment):
+    deferred_scans.setdefault(message.author.id, deque()).append((message, attachment))
+    task = deferred_scan_tasks.get(message.author.id)
+    if task is None or task.done():
+        deferred_scan_tasks[message.author.id] = asyncio.create_task(run_deferred_scans(message.author.id))
+
+async def run_deferred_scans(user_id):
+    pending = deferred_scans[user_id]
+    try:
+        while pending:
+            message, attachment = pending[0]
+            if not reserve_user_download_bytes(user_id, attachment.size):
+                await asyncio.sleep(seconds_until_budget_resets(user_id) + 0.1)
+                continue
+            pending.popleft()
+            try:
+                match = await _fetch_and_match(message, attachment)
+            except Exception as e:
+                log_event("scan_error", f"❌ Error scanning deferred attachment: {e}", logging.ERROR,
+                          guild_id=message.guild.id, message_id=message.id)
+                continue
+            if match:
+                flag_account(user_id, *match[1:], guild_id=message.guild.id)
+                await handle_scam_match(message, *match)
+                # The softban wipes their recent messages; whatever is still queued is moot.
+                break
+    finally:
+        deferred_scans.pop(user_id, None)
+        deferred_scan_tasks.pop(user_id, None)
+
+async def _fetch_and_match(message, attachment):
+    guild_id = message.guild.id if message.guild else 0
+    async with download_slot(guild_id, message.author.id, attachment.size):
+        img_bytes = await attachment.read()
+
+    # Off the event loop: an animated attachment can mean several frame decodes.
+    result = await asyncio.get_running_loop().run_in_executor(get_hash_pool(), match_scam_cascade, img_bytes)
+    if result:
+        h, dist, label, phash_dist = result
+        learn_template_shape(h, dist, label, attachment.width, attachment.height)
+        return attachment, h, dist, label, phash_dist
+    return None
+
+async def scan_message_attachments(message):
+    """Screens attachments on metadata, downloads the survivors concurrently and returns the first match."""
+    candidates = []
+    for attachment in message.attachments:
+        if prescreen_attachment(attachment):
+            continue
+        if attachment.size > get_scan_setting("max_bytes"):
+            log_event("scan_deferred", f"⏳ '{attachment.filename}' is over max_bytes, scanning it from the deferred queue.",
+                      guild_id=message.guild.id, user_id=message.author.id, filename=attachment.filename, size=attachment.size)
+            defer_attachment_scan(message, attachment)
+            continue
+        if message.author.id in deferred_scans or not reserve_user_download_bytes(message.author.id, attachment.size):
+            log_event("scan_deferred", f"⏳ Download budget exceeded for user {message.author.id}, scanning '{attachment.filename}' later.", logging.WARNING,
+                      guild_id=message.guild.id, user_id=message.author.id, filename=attachment.filename, size=attachment.size)
+            defer_attachment_scan(message, attachment)
+            continue
+        candidates.append(attachment)
+
+    if not candidates:
+        return None
+
+    scans = [asyncio.create_task(_fetch_and_match(message, attachment)) for attachment in candidates]
+    try:
+        for finished in asyncio.as_completed(scans):
+            try:
+                result = await finished
+            except Exception as e:
+                log_event("scan_error", f"❌ Error scanning attachment: {e}", logging.ERROR,
+                          guild_id=message.guild.id, message_id=message.id)
+                continue
+            if result:
+                return result
+    finally:
+        for scan in scans:
+            scan.cancel()
+    return None
+
+# --- SINGLE-FLIGHT MODERATION ---
+# A compromised account usually posts the same image into several channels and servers within
+# seconds. Only one softban per (guild, user) runs at a time; matches that arrive meanwhile wait
+# for it instead of repeating ban/unban and the log embed. Confirmed accounts are remembered for
+# a short while, so their follow-up posts in any server are deleted without downloading or hashing.
+
+moderation_inflight = {} # (guild_id, user_id, report_only) -> task running the softban or report
+flagged_accounts = {} # user_id -> match details, expiry, the guilds it matched in and the guilds already handled
+
+def flag_account(user_id, matched_hash, distance, label, phash_distance=None, guild_id=None):
+    now = time.monotonic()
+    for uid in [uid for uid, entry in flagged_accounts.items() if entry["expires"] <= now]:
+        del flagged_accounts[uid]
+    entry = flagged_accounts.setdefault(user_id, {"guilds": set(), "matched_guilds": set()})
+    entry["matched_guilds"].add(guild_id)
+    entry.update(expires=now + get_scan_setting("flagged_account_ttl_seconds"), hash=matched_hash,
+                 distance=distance, label=label, phash_distance=phash_distance)
+
+def get_flagged_account(user_id):
+    entry = flagged_accounts.get(user_id)
+    if entry and entry["expires"] <= time.monotonic():
+        del flagged_accounts[user_id]
+        return None
+    return entry
+
+def scam_evidence(matched_hash, distance, label, phash_distance=None, source="scan", message=None, filename=None):
+    """What a moderation action is based on; shown in the log embed and stored in the audit trail."""
+    return {
+        "source": source, # "scan", "flagged_cache" or "avatar"
+        "filename": filename,
+        "hash": matched_hash,
+        "distance": distance,
+        "label": label,
+        "phash_distance": phash_distance,
+        "channel_id": str(message.channel.id) if message else None,
+        "message_id": str(message.id) if message else None
+    }
+
+async def softban_single_flight(guild, author, evidence, report_only=False):
+    # Keyed by mode too, so a softban never just waits on an avatar report for the same member.
+    key = (guild.id, author.id, report_only)
+    task = moderation_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(softban_compromised_account(guild, author, evidence, report_only))
+        moderation_inflight[key] = task
+        task.add_done_callback(lambda _: moderation_inflight.pop(key, None))
+    # Shielded so a waiter being cancelled doesn't abort the softban the others are waiting on.
+    await asyncio.shield(task)
+
+async def handle_scam_match(message, attachment, matched_hash, distance, label, phash_distance=None):
     try:
         await message.delete()
     except: pass
+    await softban_single_flight(message.guild, message.author, scam_evidence(
+        matched_hash, distance, label, phash_distance, message=message, filename=attachment.filename))
 
-    author = message.author
-    guild = message.guild
+async def handle_flagged_message(message, entry):
+    try:
+        await message.delete()
+        deleted = True
+    except discord.HTTPException:
+        deleted = False
+    filename = message.attachments[0].filename if message.attachments else "(no attachment)"
+    evidence = scam_evidence(entry["hash"], entry["distance"], entry["label"], entry["phash_distance"],
+                             source="flagged_cache", message=message, filename=filename)
+    # Servers where the account matched softban it themselves. Elsewhere the evidence is another
+    # server's and this post may be plain text, so only servers that opted in kick on it.
+    softban = message.guild.id not in entry["guilds"] and (
+        message.guild.id in entry["matched_guilds"] or get_guild_config(message.guild.id).get("cross_guild_softban", False))
+    if softban:
+        await softban_single_flight(message.guild, message.author, evidence)
+        return
+
+    audit_action("flagged_delete", message.guild, message.author,
+                 f"🗑️ {'Deleted' if deleted else 'Could not delete'} a post by flagged account {message.author} ({message.author.id}) in {message.guild.name}: matched '{entry['label']}' earlier.",
+                 deleted=deleted, **evidence)
+    # Already softbanned here means the softban embed explains it; otherwise note it once per flag.
+    if message.guild.id in entry["guilds"] or message.guild.id in entry.setdefault("noted_guilds", set()):
+        return
+    entry["noted_guilds"].add(message.guild.id)
+    log_channel_id = get_guild_config(message.guild.id).get('log_channel_id')
+    log_channel = message.guild.get_channel(log_channel_id) if log_channel_id else None
+    if log_channel:
+        ttl_minutes = get_scan_setting("flagged_account_ttl_seconds") // 60
+        try:
+            await log_channel.send(
+                f"🗑️ Deleting posts by {message.author.mention} (`{message.author.id}`) for the next {ttl_minutes} min: "
+                f"the account posted the scam layout **{entry['label']}** in another server. No action was taken against the account here.")
+        except: pass
+
+async def softban_compromised_account(guild, author, evidence, report_only=False):
     gid = str(guild.id)
-    g_settings = config_data.get('guild_settings', {}).get(gid, {})
+    g_settings = get_guild_config(gid)
     log_channel_id = g_settings.get('log_channel_id')
+    label = evidence["label"]
+    distance = evidence["distance"]
     
     kick_success = False
-    try:
-        await guild.ban(
-            author, 
-            reason=f"Automated Softban: Compromised account posting scam layout ({label}).", 
-            delete_message_seconds=604800
-        )
-        
-        await guild.unban(
-            author, 
-            reason="Automated Softban: Immediate unban to keep action as a kick."
-        )
-        kick_success = True
-    except discord.Forbidden:
-        pass
+    if not report_only:
+        try:
+            await guild.ban(
+                author, 
+                reason=f"Automated Softban: Compromised account posting scam layout ({label}).", 
+                delete_message_seconds=604800
+            )
+            
+            await guild.unban(
+                author, 
+                reason="Automated Softban: Immediate unban to keep action as a kick."
+            )
+            kick_success = True
+        except discord.Forbidden:
+            pass
+
+        entry = get_flagged_account(author.id)
+        if entry:
+            entry["guilds"].add(guild.id)
+
+    if report_only:
+        action = "reported"
+        summary = f"🚩 Reported {author} ({author.id}) in {guild.name}: avatar matches '{label}'."
+    elif kick_success:
+        action = "softban"
+        summary = f"👢 Softbanned {author} ({author.id}) in {guild.name}: matched '{label}'."
+    else:
+        action = "softban_failed"
+        summary = f"⚠️ Could not softban {author} ({author.id}) in {guild.name}: missing permissions."
+    audit_action(action, guild, author, summary, **evidence)
 
     if log_channel_id:
         log_channel = guild.get_channel(log_channel_id)
         if log_channel:
+            if report_only:
+                description = f"User {author.mention} has an avatar matching a verified malicious scam image template. No action was taken."
+            elif evidence["source"] == "avatar":
+                description = f"User {author.mention} was automatically softbanned (kicked and message history wiped) for using a verified malicious scam image template as their avatar."
+            else:
+                description = f"User {author.mention} was automatically softbanned (kicked and message history wiped) for uploading a verified malicious scam image template."
             embed = discord.Embed(
-                description=f"User {author.mention} was automatically softbanned (kicked and message history wiped) for uploading a verified malicious scam image template.",
+                description=description,
                 color=discord.Color.orange(),
                 timestamp=datetime.now(timezone.utc)
             )
-            embed.set_author(name="Compromised Account Handled", icon_url=author.display_avatar.url)
+            embed.set_author(name="Suspicious Avatar Detected" if report_only else "Compromised Account Handled", icon_url=author.display_avatar.url)
             embed.add_field(name="Username", value=f"`{author}`", inline=True)
             embed.add_field(name="User ID", value=f"`{author.id}`", inline=True)
             embed.add_field(name="Detected Layout", value=f"**{label}**", inline=True)
-            embed.add_field(name="Action Taken", value="👢 **Softbanned**" if kick_success else "⚠️ **Failed to Softban (Missing Permissions)**", inline=False)
-            embed.add_field(name="Filename Detected", value=f"`{attachment.filename}`", inline=True)
+            if report_only:
+                embed.add_field(name="Action Taken", value="🚩 **Reported Only**", inline=False)
+            else:
+                embed.add_field(name="Action Taken", value="👢 **Softbanned**" if kick_success else "⚠️ **Failed to Softban (Missing Permissions)**", inline=False)
+            if evidence["source"] == "avatar":
+                embed.add_field(name="Source", value="Avatar", inline=True)
+            else:
+                embed.add_field(name="Filename Detected", value=f"`{evidence['filename']}`", inline=True)
             embed.add_field(name="Match Confidence", value=f"**{(1 - distance/64)*100:.1f}%** (Dist: `{distance}/64`)", inline=True)
+            if evidence["phash_distance"] is not None:
+                embed.add_field(name="pHash Confirmation", value=f"Dist: `{evidence['phash_distance']}/64`", inline=True)
+            if evidence["source"] == "flagged_cache":
+                embed.add_field(name="Detected Via", value="Account already flagged in another channel or server (not re-scanned)", inline=False)
             
             try:
                 await log_channel.send(embed=embed)
             except: pass
 
+# --- AVATAR SCAN ---
+# Optional ("avatar_scan": {"enabled": true}). Joining members and users changing their avatar
+# are queued and checked against the scam templates by a fixed number of workers. Results are
+# cached by Discord's avatar hash, so a raid of accounts sharing one avatar costs one download
+# and one hash; queued members with the same avatar share that single lookup.
+AVATAR_SCAN_DEFAULTS = {
+    "enabled": False,
+    "action": "report", # "report" only logs the match, "softban" handles it like a scam attachment
+    "workers": 2,
+    "queue_size": 1000,
+    "avatar_size": 128,
+    "cache_size": 10000
+}
+
+# Hashes, not verdicts, are cached: they are matched against the current scam_index on every
+# lookup, so adding or removing a template takes effect for avatars seen before.
+avatar_scan_cache = OrderedDict() # avatar key -> [(dhash, phash)] of the avatar or its sampled frames
+avatar_scan_waiting = {} # avatar key -> [(guild, member)] queued or being fetched
+avatar_scan_queue = None
+avatar_scan_workers = []
+avatar_scan_stats = {"queued": 0, "cache_hits": 0, "downloads": 0, "dropped": 0, "matches": 0}
+
+def get_avatar_scan_setting(key):
+    return config_data.get("avatar_scan", {}).get(key, AVATAR_SCAN_DEFAULTS[key])
+
+def start_avatar_scan_workers():
+    global avatar_scan_queue
+    if avatar_scan_queue is None:
+        avatar_scan_queue = asyncio.Queue(maxsize=get_avatar_scan_setting("queue_size"))
+    while len(avatar_scan_workers) < get_avatar_scan_setting("workers"):
+        avatar_scan_workers.append(asyncio.create_task(avatar_scan_worker()))
+
+async def act_on_avatar_match(guild, member, result):
+    avatar_scan_stats["matches"] += 1
+    h, dist, label, phash_dist = result
+    evidence = scam_evidence(h, dist, label, phash_dist, source="avatar")
+    await softban_single_flight(guild, member, evidence, report_only=get_avatar_scan_setting("action") != "softban")
+
+async def queue_avatar_scan(guild, member):
+    if not get_avatar_scan_setting("enabled") or not scam_index: return
+    if member.bot: return
+    avatar = member.display_avatar
+    if avatar.key == member.default_avatar.key: return
+
+    key = avatar.key
+    if key in avatar_scan_cache:
+        avatar_scan_cache.move_to_end(key)
+        avatar_scan_stats["cache_hits"] += 1
+        # Scratch stats: a re-match isn't a newly hashed image and would skew /scam_scan_stats.
+        result = match_hash_pairs(avatar_scan_cache[key], new_cascade_stats())
+        if result:
+            await act_on_avatar_match(guild, member, result)
+        return
+    waiting = avatar_scan_waiting.get(key)
+    if waiting is not None:
+        waiting.append((guild, member)) # same avatar already queued; ride along
+        avatar_scan_stats["cache_hits"] += 1
+        return
+    if avatar_scan_queue is None or avatar_scan_queue.full():
+        avatar_scan_stats["dropped"] += 1
+        return
+    avatar_scan_waiting[key] = [(guild, member)]
+    avatar_scan_queue.put_nowait((key, avatar))
+    avatar_scan_stats["queued"] += 1
+
+async def avatar_scan_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        key, avatar = await avatar_scan_queue.get()
+        result = None
+        try:
+            image_format = "gif" if avatar.is_animated() else "png"
+            data = await avatar.replace(size=get_avatar_scan_setting("avatar_size"), format=image_format).read()
+            avatar_scan_stats["downloads"] += 1
+            pairs = await loop.run_in_executor(get_hash_pool(), image_hash_pairs, data, cascade_stats)
+            result = match_hash_pairs(pairs, cascade_stats)
+            # Only cache real answers; a failed download is retried the next time the avatar shows up.
+            avatar_scan_cache[key] = pairs
+            while len(avatar_scan_cache) > get_avatar_scan_setting("cache_size"):
+                avatar_scan_cache.popitem(last=False)
+        except Exception as e:
+            log_event("avatar_scan_error", f"❌ Error scanning avatar {key}: {e}", logging.ERROR)
+        finally:
+            avatar_scan_queue.task_done()
+
+        for guild, member in avatar_scan_waiting.pop(key, []):
+            if not result: continue
+            try:
+                await act_on_avatar_match(guild, member, result)
+            except Exception as e:
+                log_event("avatar_scan_error", f"❌ Failed handling avatar match for {member.id}: {e}", logging.ERROR)
+
+# --- HISTORY BACKFILL ---
+# Walks channel history newest -> oldest so templates registered today also catch copies posted
+# before they existed. Each page is checkpointed per channel, so a restart resumes where it stopped.
+
+HISTORY_SCAN_DEFAULTS = {
+    "rest_calls_per_minute": 30,
+    "page_size": 100
+}
+
+backfill_state = {} # channel_id (str) -> checkpoint and counters
+backfill_tasks = {} # channel_id -> running asyncio.Task
+backfill_cascade_stats = {} # channel_id (str) -> cascade counters of that channel's scans, kept apart from live stats
+
+def get_history_scan_setting(key):
+    return config_data.get("history_scan", {}).get(key, HISTORY_SCAN_DEFAULTS[key])
+
+def load_backfill_state():
+    global backfill_state
+    if os.path.exists(BACKFILL_STATE_FILE):
+        try:
+            with open(BACKFILL_STATE_FILE, 'r', encoding='utf-8') as f:
+                backfill_state = json.load(f)
+        except Exception as e:
+            log_event("backfill_state_error", f"❌ Error loading '{BACKFILL_STATE_FILE}': {e}", logging.ERROR)
+            backfill_state = {}
+
+def save_backfill_state():
+    try:
+        with open(BACKFILL_STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(backfill_state, f, indent=4)
+    except Exception as e:
+        log_event("backfill_state_error", f"❌ Error saving '{BACKFILL_STATE_FILE}': {e}", logging.ERROR)
+
+SOFTBAN_REST_CALLS = 4 # delete + ban + unban + log embed
+
+def new_rest_bucket():
+    per_minute = max(1, get_history_scan_setting("rest_calls_per_minute"))
+    # The bucket must hold the largest single charge, or a softban would wait for tokens forever.
+    burst = max(float(SOFTBAN_REST_CALLS), per_minute / 12)
+    return {"rate": per_minute / 60, "capacity": burst, "tokens": burst, "last": time.monotonic()}
+
+async def spend_rest_budget(bucket, calls=1):
+    calls = min(calls, bucket["capacity"])
+    while True:
+        now = time.monotonic()
+        bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["last"]) * bucket["rate"])
+        bucket["last"] = now
+        if bucket["tokens"] >= calls:
+            bucket["tokens"] -= calls
+            return
+        await asyncio.sleep((calls - bucket["tokens"]) / bucket["rate"])
+
+def format_backfill_progress(channel, job):
+    mode = "dry run" if job["dry_run"] else "enforcing"
+    status = "✅ Finished" if job["done"] else "🔎 Scanning"
+    stats = backfill_cascade_stats.get(str(channel.id), {})
+    return (f"{status} history of {channel.mention} ({mode}): **{job['scanned_messages']}** messages, "
+            f"**{job['scanned_images']}** images checked, **{job['matches']}** matches "
+            f"({stats.get('stage1_candidates', 0)} dHash candidates, {stats.get('stage2_confirmed', 0)} pHash-confirmed).")
+
+async def scan_backfill_page(page, job, bucket, log_channel):
+    downloads = []
+    for message in page:
+        if message.author.bot:
+            continue
+        for attachment in message.attachments:
+            if not prescreen_attachment(attachment):
+                downloads.append((message, attachment))
+    if not downloads:
+        return
+
+    async def fetch(message, attachment):
+        async with download_slot(message.guild.id, message.author.id, attachment.size):
+            return await attachment.read()
+
+    payloads = await asyncio.gather(*(fetch(m, a) for m, a in downloads), return_exceptions=True)
+    fetched = [(m, a, data) for (m, a), data in zip(downloads, payloads) if isinstance(data, bytes)]
+
+    # The whole page is hashed as one batch on the shared pool.
+    loop = asyncio.get_running_loop()
+    pool = get_hash_pool()
+    stats = backfill_cascade_stats.setdefault(str(page[0].channel.id), new_cascade_stats())
+    results = await asyncio.gather(*(loop.run_in_executor(pool, match_scam_cascade, data, stats) for _, _, data in fetched))
+    job["scanned_images"] += len(fetched)
+
+    report_lines = []
+    for (message, attachment, _), result in zip(fetched, results):
+        if not result:
+            continue
+        h, dist, label, phash_dist = result
+        job["matches"] += 1
+        if job["dry_run"]:
+            report_lines.append(f"• {message.jump_url} by `{message.author}`: **{label}** (Dist: `{dist}/64`)")
+        elif message.author.id in job.setdefault("handled_authors", []):
+            # One softban per author per run; it wipes only the last 7 days, so older copies are deleted here.
+            await spend_rest_budget(bucket)
+            try:
+                await message.delete()
+            except discord.HTTPException: pass
+        else:
+            await spend_rest_budget(bucket, SOFTBAN_REST_CALLS)
+            await handle_scam_match(message, attachment, h, dist, label, phash_dist)
+            job["handled_authors"].append(message.author.id)
+
+    if report_lines and log_channel:
+        await spend_rest_budget(bucket)
+        try:
+            await log_channel.send("🧪 **History scan matches (dry run):**\n" + "\n".join(report_lines)[:1900])
+        except discord.HTTPException: pass
+
+async def run_history_backfill(channel):
+    job = backfill_state[str(channel.id)]
+    bucket = new_rest_bucket()
+    page_size = min(100, get_history_scan_setting("page_size"))
+    log_channel_id = get_guild_config(channel.guild.id).get('log_channel_id')
+    log_channel = channel.guild.get_channel(log_channel_id) if log_channel_id else None
+    progress_msg = None
+
+    async def report_progress():
+        nonlocal progress_msg
+        if not log_channel:
+            return
+        await spend_rest_budget(bucket)
+        try:
+            if progress_msg:
+                await progress_msg.edit(content=format_backfill_progress(channel, job))
+            else:
+                progress_msg = await log_channel.send(format_backfill_progress(channel, job))
+        except discord.HTTPException: pass
+
+    try:
+        while True:
+            await spend_rest_budget(bucket)
+            before = discord.Object(id=job["before"]) if job["before"] else None
+            page = [m async for m in channel.history(limit=page_size, before=before)]
+            if not page:
+                break
+
+            await scan_backfill_page(page, job, bucket, log_channel)
+            job["before"] = page[-1].id
+            job["scanned_messages"] += len(page)
+            save_backfill_state()
+            await report_progress()
+            if len(page) < page_size:
+                break
+
+        job["done"] = True
+        save_backfill_state()
+        await report_progress()
+        log_event("history_scan_finished", f"✅ History scan of #{channel.name} finished: {job['matches']} matches.",
+                  channel_id=channel.id, matches=job['matches'])
+    except asyncio.CancelledError:
+        save_backfill_state()
+        raise
+    except Exception as e:
+        log_event("history_scan_failed", f"❌ History scan of #{channel.name} stopped: {e}", logging.ERROR, channel_id=channel.id)
+    finally:
+        backfill_tasks.pop(channel.id, None)
+
+def start_history_backfill(channel):
+    if channel.id in backfill_tasks:
+        return False
+    backfill_tasks[channel.id] = asyncio.create_task(run_history_backfill(channel))
+    return True
+
+def resume_history_backfills():
+    for channel_id, job in backfill_state.items():
+        if job.get("done") or job.get("stopped"):
+            continue
+        channel = bot.get_channel(int(channel_id))
+        if channel and start_history_backfill(channel):
+            log_event("history_scan_resumed", f"🔁 Resuming history scan of #{channel.name} from checkpoint.", channel_id=channel.id)
+
+# --- SURGE COALESCING ---
+# Above a per-channel rate, welcomes are batched into one message and staff log lines are rolled
+# into a digest embed that is edited periodically, instead of one send per user. Channels drop
+# back to per-user messages once traffic falls below half the threshold.
+
+COALESCE_DEFAULTS = {
+    "enabled": True,
+    "threshold_per_minute": 12,
+    "flush_seconds": 5,
+    "digest_max_lines": 40
+}
+
+channel_send_times = {} # channel_id -> deque of send timestamps in the last minute
+surging_channels = set()
+pending_welcomes = {} # channel_id -> {"channel", "mentions", "extra"}
+log_digests = {} # log channel_id -> {"channel", "pages", "user_pages", "last_update"}
+
+def get_coalesce_setting(key):
+    return config_data.get("coalescing", {}).get(key, COALESCE_DEFAULTS[key])
+
+def channel_send_rate(channel_id):
+    times = channel_send_times.get(channel_id)
+    if not times:
+        return 0
+    cutoff = time.monotonic() - 60
+    while times and times[0] < cutoff:
+        times.popleft()
+    return len(times)
+
+def note_channel_send(channel_id):
+    """Records a send to the channel and returns True when it should be coalesced."""
+    if not get_coalesce_setting("enabled"):
+        return False
+    channel_send_times.setdefault(channel_id, deque()).append(time.monotonic())
+    if channel_id not in surging_channels and channel_send_rate(channel_id) > get_coalesce_setting("threshold_per_minute"):
+        surging_channels.add(channel_id)
+        log_event("surge_started", f"🌊 Surge in channel {channel_id}: coalescing messages.", channel_id=channel_id)
+    return channel_id in surging_channels
+
+def format_welcome(mentions, welcome_extra):
+    base_welcome = f"Welcome to the server, {', '.join(mentions)}! Please remember: **English Only**."
+    return f"{base_welcome}\n{welcome_extra}" if welcome_extra else base_welcome
+
+async def send_welcome(channel, member, welcome_extra):
+    if note_channel_send(channel.id):
+        entry = pending_welcomes.setdefault(channel.id, {"channel": channel, "mentions": [], "extra": welcome_extra})
+        entry["mentions"].append(member.mention)
+        entry["extra"] = welcome_extra
+        return
+    await channel.send(format_welcome([member.mention], welcome_extra))
+
+async def post_verification_log(log_channel, user, text):
+    """Posts a user's log line and returns the fields the session needs to update it later."""
+    if note_channel_send(log_channel.id):
+        digest = log_digests.setdefault(log_channel.id, {"channel": log_channel, "pages": [], "user_pages": {}, "last_update": 0})
+        pages = digest["pages"]
+        if not pages or len(pages[-1]["lines"]) >= get_coalesce_setting("digest_max_lines"):
+            pages.append({"message": None, "lines": OrderedDict(), "dirty": False})
+            if len(pages) > 5:
+                # Older digest messages stay as they are on Discord; their users stop being updated.
+                del pages[:-5]
+                digest["user_pages"] = {uid: page for uid, page in digest["user_pages"].items() if any(page is p for p in pages)}
+        digest["user_pages"][user.id] = pages[-1]
+        _set_digest_line(digest, user.id, text)
+        return {"log_msg_id": None, "log_digest": True}
+
+    log_msg = await log_channel.send(text)
+    return {"log_msg_id": log_msg.id}
+
+def _set_digest_line(digest, user_id, text):
+    page = digest["user_pages"].get(user_id)
+    if page is None:
+        return
+    page["lines"][user_id] = text
+    page["dirty"] = True
+    digest["last_update"] = time.monotonic()
+
+async def update_verification_log(guild_id, session, user_id, text):
+    log_channel_id = get_guild_config(guild_id).get('log_channel_id')
+    if not log_channel_id:
+        return
+    if session.get("log_digest"):
+        digest = log_digests.get(log_channel_id)
+        if digest:
+            _set_digest_line(digest, user_id, text)
+        return
+
+    log_msg_id = session.get("log_msg_id")
+    log_channel = bot.get_channel(log_channel_id)
+    if log_msg_id and log_channel:
+        try:
+            log_msg_obj = await log_channel.fetch_message(log_msg_id)
+            await log_msg_obj.edit(content=text)
+        except: pass
+
+def build_digest_embed(page):
+    embed = discord.Embed(
+        title="📋 Verification Activity (Digest)",
+        description="\n".join(page["lines"].values())[:4000],
+        color=discord.Color.blurple(),
+        timestamp=datetime.now(timezone.utc)
+    )
+    embed.set_footer(text=f"{len(page['lines'])} users · high traffic, updated every few seconds")
+    return embed
+
+@tasks.loop(seconds=5)
+async def flush_coalesced():
+    for channel_id, entry in list(pending_welcomes.items()):
+        del pending_welcomes[channel_id]
+        mentions = entry["mentions"]
+        # ~70 mentions per message keeps each one under Discord's 2000 character limit.
+        for i in range(0, len(mentions), 70):
+            try:
+                await entry["channel"].send(format_welcome(mentions[i:i + 70], entry["extra"]))
+            except Exception as e:
+                log_event("coalesce_error", f"❌ Failed sending coalesced welcome: {e}", logging.ERROR)
+
+    now = time.monotonic()
+    for channel_id, digest in list(log_digests.items()):
+        for page in digest["pages"]:
+            if not page["dirty"]:
+                continue
+            page["dirty"] = False
+            try:
+                if page["message"] is None:
+                    page["message"] = await digest["channel"].send(embed=build_digest_embed(page))
+                else:
+                    await page["message"].edit(embed=build_digest_embed(page))
+            except Exception as e:
+                log_event("coalesce_error", f"❌ Failed updating log digest: {e}", logging.ERROR)
+        # Keep the digest while sessions that started in it can still report (they expire after 6 min).
+        if channel_id not in surging_channels and now - digest["last_update"] > 600:
+            del log_digests[channel_id]
+
+    for channel_id in list(surging_channels):
+        if channel_send_rate(channel_id) < get_coalesce_setting("threshold_per_minute") / 2:
+            surging_channels.discard(channel_id)
+            log_event("surge_ended", f"✅ Traffic in channel {channel_id} back to normal: per-user messages resumed.", channel_id=channel_id)
+    # channel_send_rate drops timestamps older than a minute, so idle channels end up empty here.
+    for channel_id in [c for c in channel_send_times if not channel_send_rate(c)]:
+        del channel_send_times[channel_id]
+
+@flush_coalesced.before_loop
+async def before_flush_coalesced():
+    await bot.wait_until_ready()
+
 # --- DYNAMIC MULTI-DROPDOWN LOGIC ---
 
 class LanguageSelect(discord.ui.Select):
-    def __init__(self, parent_view, options_chunk, part_number):
+    def __init__(self, parent_view, options_chunk, part_number, custom_id=None):
+        extra = {"custom_id": custom_id} if custom_id else {}
         super().__init__(
             placeholder=f"Select Language (Part {part_number})...",
             min_values=1,
             max_values=1,
-            options=options_chunk
+            options=options_chunk,
+            **extra
         )
         self.parent_view = parent_view
 
     async def callback(self, interaction: discord.Interaction):
         lang_code = self.values[0]
+        # A persistent view is shared by every prompt, so check the prompt was addressed to this user.
+        if self.parent_view.persistent and interaction.user.id not in interaction.message.raw_mentions:
+            await interaction.response.send_message(
+                "⚠️ This menu belongs to someone else. Type **'I have read the rules'** to get your own.",
+                ephemeral=True
+            )
+            return
         await self.parent_view.send_challenge(interaction, lang_code)
 
 class LanguageView(discord.ui.View):
-    def __init__(self, log_msg_id=None):
-        super().__init__(timeout=300) 
+    def __init__(self, log_msg_id=None, persistent=False, languages=None):
+        # Persistent mode: one timeout-less view with stable custom_ids is registered at startup and
+        # attached to every prompt. The session is looked up from the user who picks, so dropdowns
+        # keep working after a restart, and cleanup_pending deletes stale prompts instead of a timer per view.
+        super().__init__(timeout=None if persistent else 300)
+        self.persistent = persistent
         self.log_msg_id = log_msg_id
+        self.languages = LANGUAGES_CONFIG if languages is None else languages
         self.message = None 
         self.create_dropdowns()
 
     def create_dropdowns(self):
         all_options = []
-        for code, details in LANGUAGES_CONFIG.items():
+        for code, details in self.languages.items():
             label = details.get("label", code)
             all_options.append(discord.SelectOption(label=label[:100], value=code))
 
@@ -396,7 +2149,8 @@ class LanguageView(discord.ui.View):
         chunks = [all_options[i:i + chunk_size] for i in range(0, len(all_options), chunk_size)]
 
         for index, chunk in enumerate(chunks):
-            select_menu = LanguageSelect(self, chunk, index + 1)
+            custom_id = f"verify:lang:{index + 1}" if self.persistent else None
+            select_menu = LanguageSelect(self, chunk, index + 1, custom_id)
             self.add_item(select_menu)
 
     async def on_timeout(self):
@@ -406,19 +2160,20 @@ class LanguageView(discord.ui.View):
             except: pass
 
     async def send_challenge(self, interaction: discord.Interaction, lang_code: str):
-        equation_str, answer_num = generate_complicated_math()
+        rules = get_rules(interaction.guild_id)
+        equation_str, answer_num = generate_complicated_math(rules)
         
         rule_key = str(answer_num)
-        if rule_key in RULES:
+        if rule_key in rules:
             if interaction.user.id in pending_verifications:
                 pending_verifications[interaction.user.id].update({
-                    "answer": RULES[rule_key],
+                    "answer": rules[rule_key],
                     "lang": lang_code,
                     "timestamp": datetime.now() 
                 })
             else:
                 pending_verifications[interaction.user.id] = {
-                    "answer": RULES[rule_key],
+                    "answer": rules[rule_key],
                     "lang": lang_code,
                     "log_msg_id": self.log_msg_id,
                     "timestamp": datetime.now(),
@@ -426,25 +2181,20 @@ class LanguageView(discord.ui.View):
                 }
             
             # Update Staff Log
-            if self.log_msg_id:
-                gid = str(interaction.guild_id)
-                g_settings = config_data.get('guild_settings', {}).get(gid, {})
-                log_channel_id = g_settings.get('log_channel_id')
-                if log_channel_id:
-                    chan = interaction.guild.get_channel(log_channel_id)
-                    if chan:
-                        try:
-                            msg = await chan.fetch_message(self.log_msg_id)
-                            lang_label = get_lang_label(lang_code)
-                            await msg.edit(content=f"⏳ {interaction.user.mention} is verifying in **{lang_label}**...")
-                        except: pass
-
-            lang_data = LANGUAGES_CONFIG.get(lang_code, {})
+            lang_label = get_lang_label(lang_code, interaction.guild_id)
+            await update_verification_log(
+                interaction.guild_id,
+                pending_verifications[interaction.user.id],
+                interaction.user.id,
+                f"⏳ {interaction.user.mention} is verifying in **{lang_label}**..."
+            )
+
+            lang_data = get_languages(interaction.guild_id).get(lang_code, {})
             msg_template = lang_data.get("message", "Error: Message missing.")
             hint_template = lang_data.get("hint", "\n\n*(Copy and paste the rule text)*")
             
             gid = str(interaction.guild_id)
-            rules_channel_id = config_data.get('guild_settings', {}).get(gid, {}).get('rules_channel_id')
+            rules_channel_id = get_guild_config(gid).get('rules_channel_id')
             rules_mention = f"<#{rules_channel_id}>" if rules_channel_id else "the rules channel"
 
             try:
@@ -452,19 +2202,207 @@ class LanguageView(discord.ui.View):
             except KeyError:
                 message_text = msg_template.replace("{equation}", equation_str).replace("{rules_channel}", rules_mention)
 
-            await interaction.response.send_message(message_text + hint_template, ephemeral=True)
+            if get_answer_mode(interaction.guild_id) == "modal":
+                await interaction.response.send_message(message_text + hint_template, view=AnswerView(lang_data), ephemeral=True)
+            else:
+                await interaction.response.send_message(message_text + hint_template, ephemeral=True)
+            pending_verifications[interaction.user.id].pop("prompt_msg_id", None)
             try:
                 await interaction.message.delete()
             except: pass
         else:
             await interaction.response.send_message("System Error: Rule config missing.", ephemeral=True)
 
+# --- VERIFICATION OUTCOME ---
+
+VERIFICATION_FAILURES = {
+    "role_not_set": "⚠️ Error: Role not set.",
+    "role_deleted": "Error: Role deleted.",
+    "forbidden": "Correct, but I lack permissions to give the role."
+}
+
+def get_answer_mode(guild_id):
+    """"message" (answer typed in the channel) or "modal" (answer submitted through a button + form)."""
+    return get_guild_config(guild_id).get("answer_mode") or config_data.get("answer_mode", "message")
+
+def wrong_answer_message(guild_id, lang_code):
+    guild_languages = get_languages(guild_id)
+    lang_data = guild_languages.get(lang_code) or guild_languages.get('en') or LANGUAGES_CONFIG.get('en', {})
+    error_msg = lang_data.get("error", "Incorrect rule text.")
+    
+    rules_channel_id = get_guild_config(guild_id).get('rules_channel_id')
+    rules_mention = f"<#{rules_channel_id}>" if rules_channel_id else "the rules channel"
+    
+    try: error_msg = error_msg.format(rules_channel=rules_mention)
+    except: pass
+    return error_msg
+
+async def complete_verification(guild, member, user_data, channel):
+    """Gives the verified role after a correct answer. Returns "verified" or a VERIFICATION_FAILURES key."""
+    g_settings = get_guild_config(guild.id)
+    verified_role_id = g_settings.get('role_id')
+    welcome_channel_id = g_settings.get('welcome_channel_id')
+    welcome_extra = g_settings.get('welcome_extra', "")
+    lang_code = user_data["lang"]
+
+    if not verified_role_id:
+        return "role_not_set"
+    role = guild.get_role(verified_role_id)
+    if not role:
+        return "role_deleted"
+    try:
+        await member.add_roles(role)
+    except discord.Forbidden:
+        return "forbidden"
+
+    audit_action("verify", guild, member,
+                 f"✅ Verified {member} ({member.id}) in {guild.name}.",
+                 lang=lang_code, role_id=str(role.id))
+    if welcome_channel_id:
+        w_channel = guild.get_channel(welcome_channel_id)
+        if w_channel: await send_welcome(w_channel, member, welcome_extra)
+    else:
+        await send_welcome(channel, member, welcome_extra)
+
+    lang_label = get_lang_label(lang_code, guild.id)
+    await update_verification_log(guild.id, user_data, member.id, f"✅ {member.mention} **Verified!** ({lang_label})")
+    pending_verifications.pop(member.id, None)
+    return "verified"
+
+# --- MODAL ANSWER FLOW ---
+# With "answer_mode": "modal", the ephemeral challenge carries a button that opens a form. The
+# answer arrives as an interaction and is answered ephemerally, so an attempt costs no message
+# deletes or channel sends and the verification channel stays quiet.
+
+class AnswerModal(discord.ui.Modal):
+    def __init__(self, lang_data):
+        super().__init__(title=lang_data.get("answer_title", "Verification")[:45])
+        self.answer = discord.ui.TextInput(
+            label=lang_data.get("answer_label", "Rule text")[:45],
+            style=discord.TextStyle.paragraph,
+            max_length=1000
+        )
+        self.add_item(self.answer)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        user_data = pending_verifications.get(interaction.user.id)
+        if not user_data or user_data.get("answer") is None:
+            await interaction.response.send_message("⏰ This verification has expired. Type **'I have read the rules'** to start again.", ephemeral=True)
+            return
+
+        if not is_close_match(self.answer.value, user_data["answer"]):
+            await interaction.response.send_message(f"❌ {wrong_answer_message(interaction.guild_id, user_data['lang'])}", ephemeral=True)
+            return
+
+        # Adding the role, welcoming and the log update can outlast the 3 s interaction window.
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        status = await complete_verification(interaction.guild, interaction.user, user_data, interaction.channel)
+        text = "✅ You have been verified." if status == "verified" else VERIFICATION_FAILURES[status]
+        await interaction.followup.send(text, ephemeral=True)
+
+class AnswerView(discord.ui.View):
+    def __init__(self, lang_data):
+        super().__init__(timeout=360) # matches the session expiry in cleanup_pending
+        self.lang_data = lang_data
+        button = discord.ui.Button(label=lang_data.get("answer_button", "Submit answer")[:80], style=discord.ButtonStyle.primary, emoji="📝")
+        button.callback = self.open_modal
+        self.add_item(button)
+
+    async def open_modal(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(AnswerModal(self.lang_data))
+
+persistent_language_view = None
+persistent_views_by_languages = {} # language set signature -> shared persistent view
+
+def register_persistent_view():
+    global persistent_language_view
+    persistent_views_by_languages.clear()
+    if not config_data.get("persistent_views"):
+        persistent_language_view = None
+        return
+    # Rebuilt on /reload so the dropdowns follow the language list; the custom_ids stay the same.
+    persistent_language_view = LanguageView(persistent=True)
+    # Picks are routed by custom_id alone and send_challenge looks the code up in the clicking guild's
+    # languages, so one registered view holding every part's custom_id answers all the variants below,
+    # including guild sets with more parts than the default list.
+    router = LanguageView(persistent=True, languages={})
+    for part in range(1, 6): # a message holds at most 5 dropdowns
+        router.add_item(LanguageSelect(router, [discord.SelectOption(label=str(part))], part, f"verify:lang:{part}"))
+    bot.add_view(router)
+
+def get_persistent_view(languages):
+    # Guilds with their own language set share one view per distinct set, used only for sending;
+    # the router registered above handles the picks.
+    if languages is LANGUAGES_CONFIG:
+        return persistent_language_view
+    signature = tuple((code, details.get("label", code)) for code, details in languages.items())
+    view = persistent_views_by_languages.get(signature)
+    if view is None:
+        view = persistent_views_by_languages[signature] = LanguageView(persistent=True, languages=languages)
+    return view
+
+LANGUAGE_PROMPT_TEXT = "please select your language:"
+
+async def delete_prompt(session):
+    prompt_msg_id = session.pop("prompt_msg_id", None)
+    channel_id = session.get("prompt_channel_id")
+    if prompt_msg_id and channel_id:
+        try:
+            await bot.get_partial_messageable(channel_id).get_partial_message(prompt_msg_id).delete()
+        except: pass
+
 # Setup Bot
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True 
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+def read_low_memory_mode():
+    # The cache mode is fixed when the bot object is built, which happens at import, before
+    # load_config(). So this one flag is read on its own; changing it needs a restart, not /reload.
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return bool(json.load(f).get('low_memory_mode', False))
+    except (OSError, ValueError):
+        return False
+
+# The member intent stays on (joins, roles on events); low-memory mode only stops
+# the bot from holding and chunking every member of every guild.
+LOW_MEMORY_MODE = read_low_memory_mode()
+
+bot = commands.Bot(
+    command_prefix="!",
+    intents=intents,
+    member_cache_flags=discord.MemberCacheFlags.none() if LOW_MEMORY_MODE else discord.MemberCacheFlags.from_intents(intents),
+    chunk_guilds_at_startup=not LOW_MEMORY_MODE
+)
+
+def report_member_cache_mode():
+    if LOW_MEMORY_MODE:
+        log_event("low_memory_mode", "🪶 Low-memory mode: member cache disabled, no chunking at startup.")
+
+MEMBER_QUERY_BATCH = 100 # Gateway limit for user_ids per member request
+
+async def resolve_guild_members(guild, user_ids):
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id)
+        if member:
+            found[user_id] = member
+        else:
+            missing.append(user_id)
+
+    if missing and LOW_MEMORY_MODE:
+        for i in range(0, len(missing), MEMBER_QUERY_BATCH):
+            batch = missing[i:i + MEMBER_QUERY_BATCH]
+            try:
+                members = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+            except Exception as e:
+                log_event("member_query_error", f"❌ Failed querying members in guild {guild.name}: {e}", logging.ERROR, guild_id=guild.id)
+                continue
+            for member in members:
+                found[member.id] = member
+    return found
 
 # --- BACKGROUND TASKS ---
 
@@ -472,19 +2410,28 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 async def cleanup_pending():
     now = datetime.now()
     to_remove = []
+    stale_prompts = []
     
     for user_id, data in pending_verifications.items():
         if "timestamp" in data:
-            if (now - data["timestamp"]).total_seconds() > 360:
+            age = (now - data["timestamp"]).total_seconds()
+            if age > 360:
                 to_remove.append((user_id, data))
+            elif age > 300 and data.get("prompt_msg_id"):
+                stale_prompts.append(data)
+
+    # Language prompts from persistent mode have no per-view timer; they expire here.
+    for data in stale_prompts:
+        await delete_prompt(data)
     
     for user_id, data in to_remove:
+        await delete_prompt(data)
         guild_id = data.get("guild_id")
         log_msg_id = data.get("log_msg_id")
         lang_code = data.get("lang")
 
         if guild_id:
-            g_settings = config_data.get('guild_settings', {}).get(str(guild_id), {})
+            g_settings = get_guild_config(guild_id)
             channel_id = g_settings.get('channel_id')
             log_channel_id = g_settings.get('log_channel_id')
             
@@ -499,28 +2446,30 @@ async def cleanup_pending():
                         )
                     except: pass
             
-            if log_channel_id and log_msg_id:
-                log_channel = bot.get_channel(log_channel_id)
-                if log_channel:
-                    try:
-                        log_msg_obj = await log_channel.fetch_message(log_msg_id)
-                        try:
-                            user = await bot.fetch_user(user_id)
-                            user_text = user.mention
-                        except:
-                            user_text = f"User {user_id}"
-                        
-                        lang_label = get_lang_label(lang_code) if lang_code else "No Selection"
-                        await log_msg_obj.edit(content=f"❌ {user_text} **Timed Out** (Lang: {lang_label})")
-                    except: pass
+            if log_channel_id and (log_msg_id or data.get("log_digest")):
+                try:
+                    user = await bot.fetch_user(user_id)
+                    user_text = user.mention
+                except:
+                    user_text = f"User {user_id}"
+                
+                lang_label = get_lang_label(lang_code, guild_id) if lang_code else "No Selection"
+                await update_verification_log(guild_id, data, user_id, f"❌ {user_text} **Timed Out** (Lang: {lang_label})")
 
         del pending_verifications[user_id]
     
     if to_remove:
-        print(f"🧹 Cleaned up {len(to_remove)} expired verifications.")
+        log_event("verifications_expired", f"🧹 Cleaned up {len(to_remove)} expired verifications.", count=len(to_remove))
+
+@cleanup_pending.before_loop
+async def before_cleanup_pending():
+    await bot.wait_until_ready()
 
 @tasks.loop(minutes=15)
 async def check_birthdays():
+    pytz = lazy_import('pytz')
+    due = {} # user_id -> year being celebrated
+
     for user_id_str, profile in list(user_profiles.items()):
         bday_info = profile.get("birthday")
         if not bday_info:
@@ -540,54 +2489,213 @@ async def check_birthdays():
         except Exception:
             continue
             
-        if now_user.month == month and now_user.day == day:
-            if last_announced != now_user.year:
-                announced_somewhere = False
-                user_id = int(user_id_str)
-                
-                for guild in bot.guilds:
-                    member = guild.get_member(user_id)
-                    if member:
-                        gid = str(guild.id)
-                        g_settings = config_data.get('guild_settings', {}).get(gid, {})
-                        bday_channel_id = g_settings.get('birthday_channel_id')
-                        
-                        if bday_channel_id:
-                            channel = guild.get_channel(bday_channel_id)
-                            if channel:
-                                try:
-                                    await channel.send(f"🎉 **Happy Birthday** to {member.mention}! Wishing you an amazing day! 🎂🎈")
-                                    announced_somewhere = True
-                                except Exception as e:
-                                    print(f"❌ Failed sending birthday in guild {guild.name}: {e}")
-                
-                if announced_somewhere:
-                    user_profiles[user_id_str]["birthday"]["last_announced"] = now_user.year
-                    save_user_data()
+        if now_user.month == month and now_user.day == day and last_announced != now_user.year:
+            due[int(user_id_str)] = now_user.year
 
-@bot.event
-async def on_ready():
+    if not due:
+        return
+
+    # Only today's birthday users are resolved, once per guild that announces birthdays.
+    announced = set()
+    for guild in bot.guilds:
+        gid = str(guild.id)
+        g_settings = get_guild_config(gid)
+        bday_channel_id = g_settings.get('birthday_channel_id')
+        if not bday_channel_id:
+            continue
+        channel = guild.get_channel(bday_channel_id)
+        if not channel:
+            continue
+
+        members = await resolve_guild_members(guild, list(due))
+        for user_id, member in members.items():
+            try:
+                await channel.send(f"🎉 **Happy Birthday** to {member.mention}! Wishing you an amazing day! 🎂🎈")
+                announced.add(user_id)
+            except Exception as e:
+                log_event("birthday_error", f"❌ Failed sending birthday in guild {guild.name}: {e}", logging.ERROR, guild_id=guild.id)
+
+    for user_id in announced:
+        user_profiles[str(user_id)]["birthday"]["last_announced"] = due[user_id]
+    if announced:
+        save_user_data()
+
+@check_birthdays.before_loop
+async def before_check_birthdays():
+    # Started from setup_hook now, before the guild cache exists.
+    await bot.wait_until_ready()
+
+@tasks.loop(hours=6)
+async def refresh_timezone_index():
+    global timezone_index
+    timezone_index = await asyncio.to_thread(build_timezone_index)
+    search_timezones.cache_clear()
+
+# --- COMMAND SYNC ---
+# Syncing pushes the whole command set to Discord and is tightly rate limited. The tree is
+# serialised the same way sync() does and hashed; the hash of the last successful sync per scope
+# (global, or a guild from "command_sync_guilds") is kept in command_sync_state.json, and a scope
+# is only synced again when its hash changes. /force_sync ignores the stored hashes.
+
+def serialize_command_tree(guild=None):
+    payload = []
+    for command in bot.tree.get_commands(guild=guild):
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:
+            payload.append(command.to_dict()) # discord.py < 2.4 takes no tree argument
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    return json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+
+def command_tree_hash(guild=None):
+    return hashlib.sha256(serialize_command_tree(guild).encode('utf-8')).hexdigest()
+
+def load_command_sync_state():
+    if os.path.exists(COMMAND_SYNC_STATE_FILE):
+        try:
+            with open(COMMAND_SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            log_event("command_sync_state_error", f"❌ Error loading '{COMMAND_SYNC_STATE_FILE}': {e}", logging.ERROR)
+    return {}
+
+def save_command_sync_state(state):
     try:
-        await bot.tree.sync()
-        if not cleanup_pending.is_running():
-            cleanup_pending.start()
-        if not check_birthdays.is_running():
-            check_birthdays.start()
-        print(f"Synced commands.")
+        with open(COMMAND_SYNC_STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=4)
     except Exception as e:
-        print(f"Failed sync: {e}")
-    print(f'Logged in as {bot.user} (ID: {bot.user.id})')
+        log_event("command_sync_state_error", f"❌ Error saving '{COMMAND_SYNC_STATE_FILE}': {e}", logging.ERROR)
+
+async def sync_commands(force=False):
+    """Syncs every scope whose command hash changed (or all with force). Returns the synced scope names."""
+    state = await asyncio.to_thread(load_command_sync_state)
+    if state.get("application_id") != bot.application_id:
+        state = {"application_id": bot.application_id, "scopes": {}} # another bot's hashes mean nothing here
+    hashes = state.setdefault("scopes", {})
+
+    scopes = [("global", None)]
+    for guild_id in config_data.get("command_sync_guilds", []):
+        guild = discord.Object(id=int(guild_id))
+        bot.tree.copy_global_to(guild=guild) # test servers see command changes instantly
+        scopes.append((f"guild:{guild_id}", guild))
+
+    synced = []
+    for name, guild in scopes:
+        tree_hash = command_tree_hash(guild)
+        if not force and hashes.get(name) == tree_hash:
+            continue
+        try:
+            await bot.tree.sync(guild=guild)
+        except Exception as e:
+            log_event("commands_sync_failed", f"Failed sync ({name}): {e}", logging.ERROR, scope=name)
+            continue
+        hashes[name] = tree_hash
+        synced.append(name)
+
+    # Guilds taken out of "command_sync_guilds" would keep their copied commands forever otherwise.
+    current = {name for name, _ in scopes}
+    for name in [n for n in hashes if n.startswith("guild:") and n not in current]:
+        guild = discord.Object(id=int(name.split(":", 1)[1]))
+        bot.tree.clear_commands(guild=guild)
+        try:
+            await bot.tree.sync(guild=guild)
+        except (discord.Forbidden, discord.NotFound):
+            pass # bot no longer in that guild; nothing left to clear
+        except Exception as e:
+            log_event("commands_sync_failed", f"Failed clearing ({name}): {e}", logging.ERROR, scope=name)
+            continue
+        del hashes[name]
+        synced.append(f"{name} (cleared)")
+
+    if synced:
+        await asyncio.to_thread(save_command_sync_state, state)
+        log_event("commands_synced", f"Synced commands: {', '.join(synced)}.", scopes=synced, forced=force)
+    else:
+        log_event("commands_synced", "Commands unchanged since the last sync, skipped.", scopes=[])
+    return synced
+
+async def resume_history_backfills_when_ready():
+    await bot.wait_until_ready()
+    resume_history_backfills()
+
+async def sweep_stale_prompts_when_ready():
+    """Deletes language prompts left over from before a restart.
+
+    Prompt ids live only in the in-memory sessions, so cleanup_pending can't reach these. The sweep
+    waits out the 5 minute prompt lifetime first, so a prompt posted just before the restart stays usable.
+    """
+    started = datetime.now(timezone.utc)
+    await bot.wait_until_ready()
+    await asyncio.sleep(300)
+    removed = 0
+    for guild in bot.guilds:
+        channel = guild.get_channel(get_guild_config(guild.id).get('channel_id') or 0)
+        if channel is None:
+            continue
+        try:
+            async for msg in channel.history(limit=200, before=started):
+                if msg.author.id == bot.user.id and LANGUAGE_PROMPT_TEXT in msg.content:
+                    await msg.delete()
+                    removed += 1
+        except discord.HTTPException as e:
+            log_event("prompt_sweep_error", f"⚠️ Could not sweep old prompts in {guild.name}: {e}", logging.WARNING, guild_id=guild.id)
+    if removed:
+        log_event("prompt_sweep", f"🧹 Deleted {removed} language prompts left over from before the restart.", removed=removed)
+
+_ready_once = False
+_login_started = 0.0
+
+@bot.event
+async def setup_hook():
+    with startup_phase("setup_hook: load user data"):
+        await asyncio.to_thread(load_user_data)
+        await asyncio.to_thread(load_backfill_state)
+        await asyncio.to_thread(load_audit_index)
+    refresh_timezone_popularity()
+    register_persistent_view()
+    apply_lag_watchdog()
+    start_avatar_scan_workers()
+
+    # setup_hook runs once per process, unlike on_ready, which fires again after every reconnect.
+    with startup_phase("setup_hook: command sync"):
+        await sync_commands()
+    cleanup_pending.start()
+    check_birthdays.start()
+    refresh_timezone_index.start()
+    flush_coalesced.change_interval(seconds=get_coalesce_setting("flush_seconds"))
+    flush_coalesced.start()
+    # Warm the deferred imports off the event loop so the first message doesn't pay for them.
+    asyncio.create_task(asyncio.to_thread(warm_heavy_imports))
+    asyncio.create_task(resume_history_backfills_when_ready())
+    asyncio.create_task(sweep_stale_prompts_when_ready())
+    startup_phases.append(("login → setup_hook", time.perf_counter() - _login_started))
+
+@bot.event
+async def on_ready():
+    global _ready_once
+    if not _ready_once:
+        _ready_once = True
+        startup_phases.append(("login → gateway ready", time.perf_counter() - _login_started))
+        if PROFILE_STARTUP:
+            report_startup_profile()
+    log_event("ready", f'Logged in as {bot.user} (ID: {bot.user.id})', user_id=bot.user.id)
 
 # --- USER COMMANDS ---
 
 @bot.tree.command(name="my_timezone", description="Set your personal timezone for automatic time translation.")
 @app_commands.describe(timezone="Select or type your timezone (e.g. America/New_York, UTC, CET)")
 async def mytimezone(interaction: discord.Interaction, timezone: str):
+    pytz = lazy_import('pytz')
     try:
         pytz.timezone(timezone)
     except pytz.UnknownTimeZoneError:
+        suggestion = ""
+        if timezone_index is not None:
+            matches = search_timezones(timezone[:64], 1)
+            if matches:
+                suggestion = f" Did you mean `{matches[0]}`?"
         await interaction.response.send_message(
-            f"❌ Unknown timezone: `{timezone}`. Please use a valid standard timezone name.",
+            f"❌ Unknown timezone: `{timezone}`. Please use a valid standard timezone name.{suggestion}",
             ephemeral=True
         )
         return
@@ -596,27 +2704,27 @@ async def mytimezone(interaction: discord.Interaction, timezone: str):
     if user_id_str not in user_profiles:
         user_profiles[user_id_str] = {}
         
+    previous = user_profiles[user_id_str].get("timezone")
     user_profiles[user_id_str]["timezone"] = timezone
     save_user_data()
+    if previous != timezone:
+        if previous:
+            timezone_popularity[previous] -= 1
+        timezone_popularity[timezone] += 1
+        search_timezones.cache_clear()
     await interaction.response.send_message(f"✅ Your timezone has been saved as: **{timezone}**", ephemeral=True)
 
 @mytimezone.autocomplete('timezone')
 async def mytimezone_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-    try:
-        all_tzs = pytz.common_timezones
-    except Exception:
-        all_tzs = [
-            "UTC", "US/Eastern", "US/Central", "US/Mountain", "US/Pacific",
-            "Europe/London", "Europe/Paris", "Europe/Berlin", "Asia/Tokyo",
-            "Asia/Kolkata", "Asia/Singapore", "Australia/Sydney", "America/Sao_Paulo"
-        ]
-    
-    choices = [
-        app_commands.Choice(name=tz, value=tz)
-        for tz in all_tzs if current.lower() in tz.lower()
-    ][:25]
-    
-    return choices
+    if timezone_index is None:
+        # Index still building right after startup.
+        return [app_commands.Choice(name=tz, value=tz) for tz in FALLBACK_TIMEZONES if current.lower() in tz.lower()]
+
+    offsets = timezone_index["offsets"]
+    return [
+        app_commands.Choice(name=f"{tz} (UTC{offsets[tz]})", value=tz)
+        for tz in search_timezones(current[:64])
+    ]
 
 @bot.tree.command(name="my_birthday", description="Register your birthday to be celebrated.")
 @app_commands.describe(month="Your birthday month", day="Your birthday day (1-31)")
@@ -670,14 +2778,14 @@ async def my_birthday(interaction: discord.Interaction, month: app_commands.Choi
 )
 @app_commands.default_permissions(administrator=True)
 async def add_scam_template(interaction: discord.Interaction, image_file: discord.Attachment, label: str):
-    if not any(image_file.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.webp']):
-        await interaction.response.send_message("❌ Uploaded file must be an image format (.png, .jpg, .jpeg, .webp).", ephemeral=True)
+    if not image_file.filename.lower().endswith(SCANNED_IMAGE_EXTENSIONS):
+        await interaction.response.send_message("❌ Uploaded file must be an image format (.png, .jpg, .jpeg, .webp, .gif). Animated files are registered by their first frame.", ephemeral=True)
         return
         
     await interaction.response.defer(ephemeral=True)
     try:
         img_bytes = await image_file.read()
-        h = bytes_dhash(img_bytes)
+        h, phash = bytes_template_hashes(img_bytes)
         if h:
             if "scam_hashes" not in config_data or isinstance(config_data["scam_hashes"], list):
                 config_data["scam_hashes"] = {}
@@ -687,20 +2795,74 @@ async def add_scam_template(interaction: discord.Interaction, image_file: discor
                 return
                 
             config_data["scam_hashes"][h] = label
+            # Shape of the template (attachment pre-screen) and its pHash (cascade confirmation).
+            config_data.setdefault("scam_template_meta", {})[h] = {
+                "width": image_file.width,
+                "height": image_file.height,
+                "size": image_file.size,
+                "phash": phash
+            }
             save_config()
+            rebuild_scam_index()
             await interaction.followup.send(f"✅ Successfully registered scam layout template!\n\n• **Label**: {label}\n• **Hash**: `{h}`", ephemeral=True)
         else:
             await interaction.followup.send("❌ Failed to resolve image properties.", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"❌ Error: {e}", ephemeral=True)
 
+@bot.tree.command(name="import_scam_templates", description="Bulk-register scam templates from a .zip of images or a hash feed file.")
+@app_commands.describe(
+    archive="A .zip of template images, or a .txt feed with one '<hash> <label>' per line",
+    label_prefix="Optional text put in front of each label (labels default to the file name)",
+    dedupe_distance="Skip images within this dHash distance of an existing template"
+)
+@app_commands.default_permissions(administrator=True)
+async def import_scam_templates(interaction: discord.Interaction, archive: discord.Attachment,
+                                label_prefix: str = None, dedupe_distance: app_commands.Range[int, 0, 32] = None):
+    filename = archive.filename.lower()
+    if not filename.endswith(('.zip', '.txt')):
+        await interaction.response.send_message("❌ Upload a .zip of images or a .txt hash feed.", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        data = await archive.read()
+        if filename.endswith('.txt'):
+            records = parse_hash_feed(data.decode('utf-8', errors='replace'))
+        else:
+            loop = asyncio.get_running_loop()
+            pool = get_hash_pool()
+            items = await loop.run_in_executor(pool, extract_zip_templates, data, label_prefix)
+            records = await asyncio.gather(*(
+                loop.run_in_executor(pool, template_record_from_bytes, label, img_bytes) for label, img_bytes in items
+            ))
+    except Exception as e:
+        await interaction.followup.send(f"❌ Error reading archive: {e}", ephemeral=True)
+        return
+
+    if dedupe_distance is None:
+        dedupe_distance = get_cascade_setting("ingest_dedupe_distance")
+    added, duplicates, failed = plan_template_ingest(records, dedupe_distance)
+    commit_template_ingest(added)
+
+    header, diff = format_ingest_summary(added, duplicates, failed)
+    body = f"📥 **Import finished:** {header}."
+    if diff:
+        room = 1900 - len(body)
+        if len(diff) > room:
+            diff = diff[:room].rsplit("\n", 1)[0] + "\n…"
+        body += f"\n```diff\n{diff}\n```"
+    await interaction.followup.send(body, ephemeral=True)
+
 @bot.tree.command(name="remove_scam_template", description="Remove a scam template layout hash from the tracking list.")
 @app_commands.describe(scam_hash="The exact 16-character hex hash of the template")
 @app_commands.default_permissions(administrator=True)
 async def remove_scam_template(interaction: discord.Interaction, scam_hash: str):
     if "scam_hashes" in config_data and scam_hash in config_data["scam_hashes"]:
         label = config_data["scam_hashes"].pop(scam_hash)
+        config_data.get("scam_template_meta", {}).pop(scam_hash, None)
         save_config()
+        rebuild_scam_index()
         await interaction.response.send_message(f"✅ Removed scam template: **{label}** (`{scam_hash}`)", ephemeral=True)
     else:
         await interaction.response.send_message("❌ Hash not found in the config database.", ephemeral=True)
@@ -713,46 +2875,237 @@ async def list_scam_templates(interaction: discord.Interaction):
         await interaction.response.send_message("ℹ️ No scam templates are registered yet.", ephemeral=True)
         return
         
-    hash_list = "\n".join(f"• `{h}`: **{label}**" for h, label in scam_hashes.items())
+    meta_table = config_data.get("scam_template_meta", {})
+    hash_list = "\n".join(
+        f"• `{h}`: **{label}**" + ("" if meta_table.get(h, {}).get("phash") else " *(dHash only)*")
+        for h, label in scam_hashes.items()
+    )
     await interaction.response.send_message(f"🔐 **Registered Scam Layout Templates ({len(scam_hashes)}):**\n{hash_list}", ephemeral=True)
 
+@bot.tree.command(name="set_scam_template_thresholds", description="Tune the cascade thresholds of one scam template.")
+@app_commands.describe(
+    scam_hash="The exact 16-character hex hash of the template",
+    dhash_threshold="Stage 1: max dHash distance for a candidate (0-64)",
+    phash_threshold="Stage 2: max pHash distance to confirm a match (0-64)"
+)
+@app_commands.default_permissions(administrator=True)
+async def set_scam_template_thresholds(interaction: discord.Interaction, scam_hash: str,
+                                       dhash_threshold: app_commands.Range[int, 0, 64] = None,
+                                       phash_threshold: app_commands.Range[int, 0, 64] = None):
+    if scam_hash not in config_data.get("scam_hashes", {}):
+        await interaction.response.send_message("❌ Hash not found in the config database.", ephemeral=True)
+        return
+    if not any(e["hash"] == scam_hash for e in scam_index):
+        # rebuild_scam_index() skips entries whose key isn't valid hex; they can never match.
+        await interaction.response.send_message("❌ This stored hash is not valid hex, so it is not used for matching. Remove it with `/remove_scam_template` and add it again.", ephemeral=True)
+        return
+
+    meta = config_data.setdefault("scam_template_meta", {}).setdefault(scam_hash, {})
+    if dhash_threshold is not None:
+        meta["dhash_threshold"] = dhash_threshold
+    if phash_threshold is not None:
+        meta["phash_threshold"] = phash_threshold
+    save_config()
+    rebuild_scam_index()
+
+    entry = next((e for e in scam_index if e["hash"] == scam_hash), None)
+    if entry is None:
+        await interaction.response.send_message("❌ Template disappeared while saving; run `/reload` and try again.", ephemeral=True)
+        return
+    stage2 = f"`{entry['phash_threshold']}`" if entry["phash"] is not None else "n/a *(no pHash stored, dHash only)*"
+    await interaction.response.send_message(
+        f"✅ Thresholds for **{entry['label']}** (`{scam_hash}`):\n• **dHash**: `{entry['dhash_threshold']}`\n• **pHash**: {stage2}",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="scam_scan_stats", description="Show hit rates of each scam hash cascade stage.")
+@app_commands.default_permissions(administrator=True)
+async def scam_scan_stats(interaction: discord.Interaction):
+    def rate(part, whole):
+        return f"{part}/{whole} ({part / whole * 100:.1f}%)" if whole else f"{part}/0"
+
+    hashed = cascade_stats["images_hashed"]
+    candidates = cascade_stats["stage1_candidates"]
+    checked = cascade_stats["stage2_checked"]
+    embed = discord.Embed(title="🔎 Scam Hash Cascade", color=discord.Color.blue())
+    embed.add_field(name="Stage 1 (dHash) Candidates", value=rate(candidates, hashed), inline=False)
+    embed.add_field(name="Stage 2 (pHash) Confirmed", value=rate(cascade_stats["stage2_confirmed"], checked), inline=False)
+    embed.add_field(name="Legacy dHash-only Matches", value=str(cascade_stats["legacy_matches"]), inline=False)
+    embed.add_field(name="Animated Images", value=(
+        f"{cascade_stats['animated_images']} scanned, {cascade_stats['frames_hashed']} frames hashed, "
+        f"{cascade_stats['frame_cache_hits']} served from the frame cache"), inline=False)
+    if get_avatar_scan_setting("enabled"):
+        embed.add_field(name="Avatar Scan", value=(
+            f"{avatar_scan_stats['downloads']} downloaded, {avatar_scan_stats['cache_hits']} served from cache, "
+            f"{avatar_scan_stats['matches']} matches, {avatar_scan_stats['dropped']} dropped (queue full)"), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="audit_query", description="Look up moderation actions in the local audit trail.")
+@app_commands.describe(
+    user="Only show actions taken against this user",
+    action="Only show this kind of action",
+    limit="How many records to show, newest first (default: 10)"
+)
+@app_commands.choices(action=[
+    app_commands.Choice(name="Softban", value="softban"),
+    app_commands.Choice(name="Softban failed", value="softban_failed"),
+    app_commands.Choice(name="New-account timeout", value="timeout"),
+    app_commands.Choice(name="Timeout failed", value="timeout_failed"),
+    app_commands.Choice(name="Verification", value="verify"),
+    app_commands.Choice(name="Avatar report", value="reported"),
+    app_commands.Choice(name="Flagged post deleted", value="flagged_delete")
+])
+@app_commands.default_permissions(administrator=True)
+async def audit_query(interaction: discord.Interaction, user: discord.User = None,
+                      action: app_commands.Choice[str] = None, limit: app_commands.Range[int, 1, 25] = 10):
+    entries = await asyncio.to_thread(
+        query_audit, interaction.guild_id, user.id if user else None, action.value if action else None, limit)
+    if not entries:
+        await interaction.response.send_message("ℹ️ No matching audit records.", ephemeral=True)
+        return
+
+    lines = []
+    for entry in entries:
+        try:
+            stamp = f"<t:{int(datetime.fromisoformat(entry['ts']).timestamp())}:f>"
+        except (KeyError, ValueError):
+            stamp = entry.get("ts", "?")
+        details = [f"age {entry.get('account_age_days', '?')}d"]
+        if entry.get("label"):
+            details.append(f"**{entry['label']}** `{entry.get('hash')}` dist {entry.get('distance')}"
+                           + (f" / pHash {entry['phash_distance']}" if entry.get("phash_distance") is not None else ""))
+        if entry.get("lang"):
+            details.append(f"lang `{entry['lang']}`")
+        lines.append(f"{stamp} `{entry['action']}` <@{entry['user_id']}> ({', '.join(details)})")
+
+    embed = discord.Embed(title="🗃️ Moderation Audit Trail", description="\n".join(lines)[:4096], color=discord.Color.blue())
+    embed.set_footer(text=f"{len(entries)} record(s), newest first")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="lag_report", description="Show the call sites that blocked the event loop the longest.")
+@app_commands.describe(reset="Clear the collected statistics after showing them")
+@app_commands.default_permissions(administrator=True)
+async def lag_report(interaction: discord.Interaction, reset: bool = False):
+    if lag_stats["since"] is None:
+        await interaction.response.send_message("ℹ️ The lag watchdog is off. Set `\"lag_watchdog\": {\"enabled\": true}` in the config and `/reload`.", ephemeral=True)
+        return
+
+    top_n = get_lag_setting("top_n")
+    report = format_lag_report(top_n) or "No stalls over the threshold so far."
+    embed = discord.Embed(title="🐢 Event Loop Lag", description=f"```\n{report[:3900]}\n```", color=discord.Color.blue())
+    embed.add_field(name="Probes", value=str(lag_stats["probes"]), inline=True)
+    embed.add_field(name="Stalls", value=f"{lag_stats['stalls']} (> {get_lag_setting('threshold_ms')} ms)", inline=True)
+    embed.add_field(name="Worst Lag", value=f"{lag_stats['max_lag_ms']:.0f} ms", inline=True)
+    worst = top_lag_sites(1)
+    if worst and worst[0][1]["stack"]:
+        embed.add_field(name="Stack of the Top Site", value=f"```\n{worst[0][1]['stack'][-1000:]}\n```", inline=False)
+    embed.set_footer(text=f"Collecting since {lag_stats['since']:%Y-%m-%d %H:%M} UTC")
+
+    if reset:
+        with lag_lock:
+            lag_sites.clear()
+            lag_stats.update(probes=0, stalls=0, max_lag_ms=0.0, since=datetime.now(timezone.utc))
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="scan_history", description="Scan a channel's past messages for registered scam templates.")
+@app_commands.describe(
+    channel="The channel whose history should be scanned",
+    dry_run="Only report matches in the log channel instead of softbanning (default: on)",
+    restart="Ignore the saved checkpoint and start again from the newest message"
+)
+@app_commands.default_permissions(administrator=True)
+async def scan_history(interaction: discord.Interaction, channel: discord.TextChannel, dry_run: bool = True, restart: bool = False):
+    if channel.id in backfill_tasks:
+        await interaction.response.send_message(f"⚠️ {channel.mention} is already being scanned.", ephemeral=True)
+        return
+
+    key = str(channel.id)
+    job = backfill_state.get(key)
+    resumed = job is not None and not job.get("done") and not restart
+    if not resumed:
+        job = backfill_state[key] = {
+            "guild_id": interaction.guild_id,
+            "before": None,
+            "scanned_messages": 0,
+            "scanned_images": 0,
+            "matches": 0,
+            "done": False
+        }
+    job["dry_run"] = dry_run
+    job["stopped"] = False
+    save_backfill_state()
+
+    start_history_backfill(channel)
+    where = "from the saved checkpoint" if resumed else "from the newest message"
+    await interaction.response.send_message(
+        f"🔎 History scan of {channel.mention} started {where} ({'dry run' if dry_run else 'enforcing'}). Progress is posted in the log channel.",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="stop_history_scan", description="Stop a running history scan (its checkpoint is kept).")
+@app_commands.default_permissions(administrator=True)
+async def stop_history_scan(interaction: discord.Interaction, channel: discord.TextChannel):
+    task = backfill_tasks.get(channel.id)
+    job = backfill_state.get(str(channel.id))
+    if not task or not job:
+        await interaction.response.send_message(f"ℹ️ No history scan is running in {channel.mention}.", ephemeral=True)
+        return
+
+    job["stopped"] = True
+    task.cancel()
+    save_backfill_state()
+    await interaction.response.send_message(
+        f"⏹️ Stopped the history scan of {channel.mention} after **{job['scanned_messages']}** messages. Run `/scan_history` to resume.",
+        ephemeral=True
+    )
+
 @bot.tree.command(name="set_birthday_channel", description="Set the channel where birthday announcements will be posted.")
 @app_commands.default_permissions(administrator=True)
 async def set_birthday_channel(interaction: discord.Interaction):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
+    settings = edit_guild_config(gid)
     
-    config_data['guild_settings'][gid]['birthday_channel_id'] = interaction.channel.id
-    save_config()
+    settings['birthday_channel_id'] = interaction.channel.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Birthday channel set to: {interaction.channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="reload", description="Reloads config file.")
 @app_commands.default_permissions(administrator=True)
 async def reload(interaction: discord.Interaction):
     if load_config():
+        register_persistent_view()
+        apply_lag_watchdog()
+        start_avatar_scan_workers()
         await interaction.response.send_message(f"✅ Configuration Reloaded!", ephemeral=True)
     else:
         await interaction.response.send_message("❌ Reload Failed.", ephemeral=True)
 
+@bot.tree.command(name="force_sync", description="Push the slash commands to Discord even if they look unchanged.")
+@app_commands.default_permissions(administrator=True)
+async def force_sync(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    synced = await sync_commands(force=True)
+    if synced:
+        await interaction.followup.send(f"✅ Synced commands ({', '.join(synced)}). Global changes can take a while to show up.", ephemeral=True)
+    else:
+        await interaction.followup.send("❌ Sync failed, see the event log.", ephemeral=True)
+
 @bot.tree.command(name="set_verification_channel", description="Where users type commands.")
 @app_commands.default_permissions(administrator=True)
 async def set_verification_channel(interaction: discord.Interaction):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
-    config_data['guild_settings'][gid]['channel_id'] = interaction.channel.id
-    save_config()
+    settings = edit_guild_config(gid)
+    settings['channel_id'] = interaction.channel.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Verification Channel set to: {interaction.channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="set_welcome_channel", description="Where welcome messages appear.")
 @app_commands.default_permissions(administrator=True)
 async def set_welcome_channel(interaction: discord.Interaction):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
-    config_data['guild_settings'][gid]['welcome_channel_id'] = interaction.channel.id
-    save_config()
+    settings = edit_guild_config(gid)
+    settings['welcome_channel_id'] = interaction.channel.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Welcome Channel set to: {interaction.channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="set_welcome_extra", description="Add extra text/links after the default welcome message.")
@@ -760,37 +3113,34 @@ async def set_welcome_channel(interaction: discord.Interaction):
 @app_commands.default_permissions(administrator=True)
 async def set_welcome_extra(interaction: discord.Interaction, text: str = None):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
+    settings = edit_guild_config(gid)
     
     if text:
-        config_data['guild_settings'][gid]['welcome_extra'] = text
-        save_config()
+        settings['welcome_extra'] = text
+        save_guild_config(gid)
         await interaction.response.send_message(f"✅ Welcome message extra text updated:\n\n*...English Only.*\n**{text}**", ephemeral=True)
     else:
-        config_data['guild_settings'][gid]['welcome_extra'] = ""
-        save_config()
+        settings['welcome_extra'] = ""
+        save_guild_config(gid)
         await interaction.response.send_message(f"✅ Welcome message extra text **removed**.", ephemeral=True)
 
 @bot.tree.command(name="set_log_channel", description="Where staff see verification progress.")
 @app_commands.default_permissions(administrator=True)
 async def set_log_channel(interaction: discord.Interaction):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
-    config_data['guild_settings'][gid]['log_channel_id'] = interaction.channel.id
-    save_config()
+    settings = edit_guild_config(gid)
+    settings['log_channel_id'] = interaction.channel.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Log/Progress Channel set to: {interaction.channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="set_rules_channel", description="The channel containing the rules list.")
 @app_commands.default_permissions(administrator=True)
 async def set_rules_channel(interaction: discord.Interaction, channel: discord.TextChannel):
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
+    settings = edit_guild_config(gid)
     
-    config_data['guild_settings'][gid]['rules_channel_id'] = channel.id
-    save_config()
+    settings['rules_channel_id'] = channel.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Rules Channel set to: {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="set_role", description="Set verified role.")
@@ -800,17 +3150,16 @@ async def set_role(interaction: discord.Interaction, role: discord.Role):
         await interaction.response.send_message("⚠️ Unsafe: Cannot use Admin role.", ephemeral=True)
         return
     gid = str(interaction.guild_id)
-    if "guild_settings" not in config_data: config_data["guild_settings"] = {}
-    if gid not in config_data['guild_settings']: config_data['guild_settings'][gid] = {}
-    config_data['guild_settings'][gid]['role_id'] = role.id
-    save_config()
+    settings = edit_guild_config(gid)
+    settings['role_id'] = role.id
+    save_guild_config(gid)
     await interaction.response.send_message(f"✅ Role set: **{role.name}**", ephemeral=True)
 
 @bot.tree.command(name="check_config", description="View current config.")
 @app_commands.default_permissions(administrator=True)
 async def check_config(interaction: discord.Interaction):
     gid = str(interaction.guild_id)
-    settings = config_data.get('guild_settings', {}).get(gid, {})
+    settings = get_guild_config(gid)
     
     def get_status(obj_id, type_func):
         if not obj_id: return "❌ Not Set"
@@ -838,108 +3187,118 @@ async def check_config(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-# --- MAIN LOGIC ---
-
-@bot.event
-async def on_message_edit(before, after):
-    if after.author.bot: return
-    if before.content == after.content: return
-
-    g_settings = config_data.get('guild_settings', {}).get(str(after.guild.id), {})
-    allowed_channel_id = g_settings.get('channel_id')
-    is_verification_channel = (allowed_channel_id is not None) and (after.channel.id == allowed_channel_id)
-    if is_verification_channel: return
-
-    user_id_str = str(after.author.id)
-    user_tz_name = user_profiles.get(user_id_str, {}).get("timezone")
-    
-    bot_reply_id = msg_translation_map.get(after.id)
-
-    parsed_segments = []
-    if user_tz_name:
-        parsed_segments = extract_and_parse_all(after.content)
+# --- EDIT DEBOUNCE ---
 
-    epochs = []
-    if parsed_segments:
-        try:
-            user_tz = pytz.timezone(user_tz_name)
-            now_user_time = datetime.now(user_tz)
-            
-            for segment_text, format_type in parsed_segments:
-                preprocessed_text = preprocess_natural_time(segment_text)
-                settings = {
-                    'PREFER_DATES_FROM': 'future',
-                    'RELATIVE_BASE': now_user_time.replace(tzinfo=None),
-                    'TIMEZONE': user_tz_name,
-                    'RETURN_AS_TIMEZONE_AWARE': True
-                }
-                parsed_dt = dateparser.parse(preprocessed_text, settings=settings)
-                if parsed_dt:
-                    epoch = int(parsed_dt.timestamp())
-                    epochs.append((epoch, format_type))
-        except Exception:
-            pass
+EDIT_DEBOUNCE_DEFAULT_SECONDS = 1.5
 
-    if epochs:
-        formatted_times = [f"<t:{epoch}:{fmt}>" for epoch, fmt in epochs]
-        if len(formatted_times) == 1:
-            reply_text = f"The user means {formatted_times[0]}"
-        elif len(formatted_times) == 2:
-            reply_text = f"The user means {formatted_times[0]} or {formatted_times[1]}"
-        else:
-            reply_text = f"The user means {', '.join(formatted_times[:-1])}, or {formatted_times[-1]}"
+edit_generations = {} # user_message_id -> generation of the latest edit
+edit_debounce_tasks = {} # user_message_id -> task still in its quiet period
+edit_locks = {} # user_message_id -> lock serialising the REST calls for that message
 
+async def process_message_edit(message, generation):
+    try:
+        await asyncio.sleep(float(config_data.get("edit_debounce_seconds", EDIT_DEBOUNCE_DEFAULT_SECONDS)))
+    except asyncio.CancelledError:
+        return # superseded by a newer edit during the quiet period
+    # Past the quiet period this run is no longer cancelled, so a REST call is never cut off
+    # halfway; newer edits queue on the lock and the generation check skips stale runs.
+    if edit_debounce_tasks.get(message.id) is asyncio.current_task():
+        del edit_debounce_tasks[message.id]
+
+    lock = edit_locks.setdefault(message.id, asyncio.Lock())
+    try:
+        async with lock:
+            if edit_generations.get(message.id) != generation: return
+            user_tz_name = user_profiles.get(str(message.author.id), {}).get("timezone")
+            reply_text = build_time_reply(message.content, user_tz_name) if user_tz_name else None
+            await sync_time_reply(message, reply_text)
+    finally:
+        if edit_generations.get(message.id) == generation:
+            edit_generations.pop(message.id, None)
+            edit_locks.pop(message.id, None)
+
+async def sync_time_reply(message, reply_text):
+    bot_reply_id = msg_translation_map.get(message.id)
+
+    if reply_text:
         if bot_reply_id:
+            if msg_reply_text.get(message.id) == reply_text:
+                return # the reply already says this
             try:
-                msg = await after.channel.fetch_message(bot_reply_id)
+                msg = await message.channel.fetch_message(bot_reply_id)
                 await msg.edit(content=reply_text)
+                msg_reply_text[message.id] = reply_text
             except discord.NotFound:
                 try:
-                    reply = await after.reply(reply_text, mention_author=False)
-                    msg_translation_map[after.id] = reply.id
+                    reply = await message.reply(reply_text, mention_author=False)
+                    add_to_translation_map(message.id, reply.id, reply_text)
                 except: pass
             except: pass
         else:
             try:
-                reply = await after.reply(reply_text, mention_author=False)
-                add_to_translation_map(after.id, reply.id)
+                reply = await message.reply(reply_text, mention_author=False)
+                add_to_translation_map(message.id, reply.id, reply_text)
             except: pass
     else:
         if bot_reply_id:
             try:
-                msg = await after.channel.fetch_message(bot_reply_id)
+                msg = await message.channel.fetch_message(bot_reply_id)
                 await msg.delete()
             except: pass
-            msg_translation_map.pop(after.id, None)
+            msg_translation_map.pop(message.id, None)
+            msg_reply_text.pop(message.id, None)
+
+# --- MAIN LOGIC ---
+
+@bot.event
+async def on_member_join(member):
+    await queue_avatar_scan(member.guild, member)
+
+@bot.event
+async def on_user_update(before, after):
+    if before.avatar == after.avatar: return
+    for guild in after.mutual_guilds:
+        await queue_avatar_scan(guild, after)
+
+@bot.event
+async def on_message_edit(before, after):
+    if after.author.bot: return
+    if before.content == after.content: return
+
+    g_settings = get_guild_config(after.guild.id)
+    allowed_channel_id = g_settings.get('channel_id')
+    is_verification_channel = (allowed_channel_id is not None) and (after.channel.id == allowed_channel_id)
+    if is_verification_channel: return
+
+    # A burst of typo fixes should cost one parse and at most one REST call, for the final text.
+    # Each edit bumps the message's generation and restarts the quiet period; a run that
+    # is no longer the latest generation drops out before touching Discord.
+    generation = edit_generations.get(after.id, 0) + 1
+    edit_generations[after.id] = generation
+    waiting = edit_debounce_tasks.get(after.id)
+    if waiting and not waiting.done():
+        waiting.cancel()
+    edit_debounce_tasks[after.id] = asyncio.create_task(process_message_edit(after, generation))
 
 @bot.event
 async def on_message(message):
     if message.author.bot: return
 
     # 1. SCAN FOR MALICIOUS SCAM ATTACHMENTS
-    if message.attachments:
-        scam_hashes = config_data.get("scam_hashes", {})
-        if scam_hashes:
-            for attachment in message.attachments:
-                if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.webp']):
-                    try:
-                        img_bytes = await attachment.read()
-                        h = bytes_dhash(img_bytes)
-                        if h:
-                            for template_hash, label in scam_hashes.items():
-                                dist = hamming_distance(h, template_hash)
-                                if dist <= 12: 
-                                    await handle_scam_match(message, attachment, h, dist, label)
-                                    return
-                    except Exception as e:
-                        print(f"❌ Error scanning attachment: {e}")
-
-    g_settings = config_data.get('guild_settings', {}).get(str(message.guild.id), {})
+    flagged = get_flagged_account(message.author.id)
+    if flagged:
+        await handle_flagged_message(message, flagged)
+        return
+    if message.attachments and scam_index:
+        match = await scan_message_attachments(message)
+        if match:
+            flag_account(message.author.id, *match[1:], guild_id=message.guild.id)
+            await handle_scam_match(message, *match)
+            return
+
+    g_settings = get_guild_config(message.guild.id)
     allowed_channel_id = g_settings.get('channel_id')
-    welcome_channel_id = g_settings.get('welcome_channel_id')
     log_channel_id = g_settings.get('log_channel_id')
-    verified_role_id = g_settings.get('role_id')
-    welcome_extra = g_settings.get('welcome_extra', "")
 
     # 2. TRIGGER
     if VERIFY_PATTERN.fullmatch(message.content.strip()):
@@ -951,33 +3310,53 @@ async def on_message(message):
         if age_delta.days < MIN_AGE:
             try:
                 await message.author.timeout(timedelta(days=7), reason="Account too new")
-                warn = await message.channel.send(f"🚫 {message.author.mention}, account < {MIN_AGE} days old. Timeout 7 days.")
-                await asyncio.sleep(10)
-                await warn.delete()
             except discord.Forbidden:
-                await message.channel.send("Account too new (Permission Error).", delete_after=5)
+                audit_action("timeout_failed", message.guild, message.author,
+                             f"⚠️ Could not time out {message.author} ({message.author.id}) in {message.guild.name}: missing permissions.",
+                             min_age_days=MIN_AGE, channel_id=str(message.channel.id))
+                try: await message.channel.send("Account too new (Permission Error).", delete_after=5)
+                except: pass
+                return
+            audit_action("timeout", message.guild, message.author,
+                         f"🚫 Timed out {message.author} ({message.author.id}) in {message.guild.name}: account {age_delta.days} days old.",
+                         min_age_days=MIN_AGE, duration_days=7, channel_id=str(message.channel.id))
+            # The timeout already happened; a failed warning must not be logged as a failed timeout.
+            try: await message.channel.send(f"🚫 {message.author.mention}, account < {MIN_AGE} days old. Timeout 7 days.", delete_after=10)
+            except: pass
             return
 
-        log_msg_id = None
+        log_ref = {"log_msg_id": None}
         if log_channel_id:
             log_channel = message.guild.get_channel(log_channel_id)
             if log_channel:
                 try:
-                    log_msg = await log_channel.send(f"⏳ {message.author.mention} is attempting verification...")
-                    log_msg_id = log_msg.id
+                    log_ref = await post_verification_log(log_channel, message.author, f"⏳ {message.author.mention} is attempting verification...")
                 except: pass
+        log_msg_id = log_ref["log_msg_id"]
+
+        previous_session = pending_verifications.get(message.author.id)
+        if previous_session:
+            await delete_prompt(previous_session)
 
         pending_verifications[message.author.id] = {
             "answer": None, 
             "lang": None,
-            "log_msg_id": log_msg_id,
+            **log_ref,
             "timestamp": datetime.now(),
             "guild_id": message.guild.id
         }
 
-        view = LanguageView(log_msg_id)
-        prompt_msg = await message.channel.send(f"Hello {message.author.mention}, please select your language:", view=view)
-        view.message = prompt_msg
+        guild_languages = get_languages(message.guild.id)
+        if persistent_language_view:
+            prompt_msg = await message.channel.send(f"Hello {message.author.mention}, {LANGUAGE_PROMPT_TEXT}", view=get_persistent_view(guild_languages))
+            pending_verifications[message.author.id].update({
+                "prompt_channel_id": message.channel.id,
+                "prompt_msg_id": prompt_msg.id
+            })
+        else:
+            view = LanguageView(log_msg_id, languages=guild_languages)
+            prompt_msg = await message.channel.send(f"Hello {message.author.mention}, {LANGUAGE_PROMPT_TEXT}", view=view)
+            view.message = prompt_msg
         return
 
     # 3. ANSWER CHECK
@@ -991,60 +3370,17 @@ async def on_message(message):
 
         expected_text = user_data["answer"]
         lang_code = user_data["lang"]
-        stored_log_id = user_data.get("log_msg_id")
         
         if is_close_match(message.content, expected_text):
-            if not verified_role_id:
-                await message.channel.send("⚠️ Error: Role not set.", delete_after=10)
-                return
-
-            role = message.guild.get_role(verified_role_id)
-            if role:
-                try:
-                    await message.author.add_roles(role)
-                    await message.channel.send(f"✅ {message.author.mention} has been verified.", delete_after=5)
-                    
-                    base_welcome = f"Welcome to the server, {message.author.mention}! Please remember: **English Only**."
-                    
-                    if welcome_extra:
-                        final_welcome = f"{base_welcome}\n{welcome_extra}"
-                    else:
-                        final_welcome = base_welcome
-
-                    if welcome_channel_id:
-                        w_channel = message.guild.get_channel(welcome_channel_id)
-                        if w_channel: await w_channel.send(final_welcome)
-                    else:
-                        await message.channel.send(final_welcome)
-
-                    if log_channel_id and stored_log_id:
-                        l_channel = message.guild.get_channel(log_channel_id)
-                        if l_channel:
-                            try:
-                                log_msg_obj = await l_channel.fetch_message(stored_log_id)
-                                lang_label = get_lang_label(lang_code)
-                                await log_msg_obj.edit(content=f"✅ {message.author.mention} **Verified!** ({lang_label})")
-                            except: pass
-
-                    del pending_verifications[message.author.id]
-
-                except discord.Forbidden:
-                    await message.channel.send("Correct, but I lack permissions to give the role.", delete_after=10)
+            status = await complete_verification(message.guild, message.author, user_data, message.channel)
+            if status == "verified":
+                await message.channel.send(f"✅ {message.author.mention} has been verified.", delete_after=5)
             else:
-                await message.channel.send("Error: Role deleted.", delete_after=10)
+                await message.channel.send(VERIFICATION_FAILURES[status], delete_after=10)
             return
         else:
-            lang_data = LANGUAGES_CONFIG.get(lang_code, LANGUAGES_CONFIG['en'])
-            error_msg = lang_data.get("error", "Incorrect rule text.")
-            
-            rules_channel_id = config_data.get('guild_settings', {}).get(str(message.guild.id), {}).get('rules_channel_id')
-            rules_mention = f"<#{rules_channel_id}>" if rules_channel_id else "the rules channel"
-            
-            try: error_msg = error_msg.format(rules_channel=rules_mention)
-            except: pass
-
             await message.channel.send(
-                f"❌ {message.author.mention} {error_msg}", 
+                f"❌ {message.author.mention} {wrong_answer_message(message.guild.id, lang_code)}", 
                 delete_after=30
             )
             return
@@ -1056,45 +3392,125 @@ async def on_message(message):
         user_tz_name = user_profiles.get(user_id_str, {}).get("timezone")
         
         if user_tz_name:
-            parsed_segments = extract_and_parse_all(message.content)
-            epochs = []
-            
-            if parsed_segments:
-                try:
-                    user_tz = pytz.timezone(user_tz_name)
-                    now_user_time = datetime.now(user_tz)
-                    
-                    for segment_text, format_type in parsed_segments:
-                        preprocessed_text = preprocess_natural_time(segment_text)
-                        settings = {
-                            'PREFER_DATES_FROM': 'future',
-                            'RELATIVE_BASE': now_user_time.replace(tzinfo=None),
-                            'TIMEZONE': user_tz_name,
-                            'RETURN_AS_TIMEZONE_AWARE': True
-                        }
-                        
-                        parsed_dt = dateparser.parse(preprocessed_text, settings=settings)
-                        if parsed_dt:
-                            epoch = int(parsed_dt.timestamp())
-                            epochs.append((epoch, format_type))
-                except Exception:
-                    pass
-            
-            if epochs:
-                formatted_times = [f"<t:{epoch}:{fmt}>" for epoch, fmt in epochs]
-                if len(formatted_times) == 1:
-                    reply_text = f"The user means {formatted_times[0]}"
-                elif len(formatted_times) == 2:
-                    reply_text = f"The user means {formatted_times[0]} or {formatted_times[1]}"
-                else:
-                    reply_text = f"The user means {', '.join(formatted_times[:-1])}, or {formatted_times[-1]}"
-                    
+            reply_text = build_time_reply(message.content, user_tz_name)
+            if reply_text:
                 try:
                     reply = await message.reply(reply_text, mention_author=False)
-                    add_to_translation_map(message.id, reply.id)
+                    add_to_translation_map(message.id, reply.id, reply_text)
                 except Exception:
                     pass
 
     await bot.process_commands(message)
 
-bot.run(TOKEN)
\ No newline at end of file
+# --- MEMORY BENCHMARK ---
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _synthetic_member_payload(user_id):
+    return {
+        "user": {"id": str(user_id), "username": f"member{user_id}", "discriminator": "0", "avatar": None, "global_name": None},
+        "roles": [],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0
+    }
+
+def _measure_member_cache_rss(low_memory, member_count):
+    # Runs in a fresh process per mode so RSS isn't skewed by the other run's heap.
+    import gc
+    state = bot._connection
+    state.member_cache_flags = discord.MemberCacheFlags.none() if low_memory else discord.MemberCacheFlags.from_intents(intents)
+    guild = discord.Guild(data={
+        "id": "1", "name": "Synthetic", "member_count": member_count, "large": True, "owner_id": "1",
+        "members": [], "channels": [], "roles": [], "emojis": [], "stickers": [], "features": []
+    }, state=state)
+
+    gc.collect()
+    rss_before = _current_rss_bytes()
+    # Same path discord.py takes for GUILD_MEMBERS_CHUNK: build members, keep them only if the cache flags say so.
+    chunk_size = 1000
+    for start in range(0, member_count, chunk_size):
+        chunk = [_synthetic_member_payload(10**17 + i) for i in range(start, min(start + chunk_size, member_count))]
+        members = [discord.Member(data=data, guild=guild, state=state) for data in chunk]
+        if state.member_cache_flags.joined:
+            for member in members:
+                guild._add_member(member)
+    del chunk, members
+    gc.collect()
+    rss_after = _current_rss_bytes()
+
+    retained = None if rss_before is None else rss_after - rss_before
+    return len(guild.members), retained
+
+def run_memory_benchmark(member_count):
+    import concurrent.futures
+    import multiprocessing
+
+    print(f"📊 Member cache memory benchmark: synthetic guild with {member_count:,} members")
+    ctx = multiprocessing.get_context('spawn')
+    for mode_name, low_memory in (("default", False), ("low-memory", True)):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            cached, retained = pool.submit(_measure_member_cache_rss, low_memory, member_count).result()
+        rss_text = f"{retained / (1024 * 1024):.1f} MiB RSS" if retained is not None else "RSS unavailable on this platform"
+        print(f"   {mode_name:<11} cached members: {cached:>9,}   {rss_text}")
+
+# --- ENTRY POINT ---
+
+def main():
+    global PROFILE_STARTUP, _login_started
+    parser = argparse.ArgumentParser(description="Sphere Matchers verification & utility bot.")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Print per-phase import and init timings once the bot is ready.")
+    parser.add_argument('--bench-memory', type=int, metavar='MEMBERS',
+                        help="Compare member cache RSS between default and low-memory mode on a synthetic guild, then exit.")
+    parser.add_argument('--ingest-templates', metavar='PATH',
+                        help="Bulk-register scam templates from a directory of images or a '<hash> <label>' feed file, then exit.")
+    parser.add_argument('--dedupe-distance', type=int,
+                        help="With --ingest-templates: skip images within this dHash distance of an existing template.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="With --ingest-templates: print the summary without writing the config.")
+    args = parser.parse_args()
+    PROFILE_STARTUP = args.profile_startup
+
+    if args.bench_memory:
+        run_memory_benchmark(args.bench_memory)
+        return
+
+    if args.ingest_templates:
+        # Offline ingest only touches templates; it doesn't need a usable token.
+        if not load_config(require_token=False):
+            sys.exit(1)
+        run_template_ingest_cli(args.ingest_templates, args.dedupe_distance, args.dry_run)
+        return
+
+    # The token lives in the config file, so this is the one load that has to happen before login.
+    with startup_phase("load config"):
+        config_ok = load_config()
+    if not config_ok:
+        sys.exit(1)
+
+    start_event_log()
+    try:
+        with open(PID_FILE, 'w') as f:
+            f.write(str(os.getpid()))
+    except OSError:
+        pass
+    try:
+        report_member_cache_mode()
+        _login_started = time.perf_counter()
+        bot.run(TOKEN)
+    finally:
+        try:
+            os.remove(PID_FILE)
+        except OSError:
+            pass
+        stop_event_log()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file